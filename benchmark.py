@@ -0,0 +1,481 @@
+import argparse
+import asyncio
+import contextvars
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+# keep the benchmark data out of the working tree
+os.environ['DATABASE_URL'] = f'sqlite+aiosqlite:///{tempfile.mkdtemp()}/benchmark.db'
+
+import httpx  # noqa: E402
+from sqlalchemy import event, insert, select, literal  # noqa: E402
+
+from models import Base, UserModel, PostModel, LikeModel, CommentModel  # noqa: E402
+from database import engine, session_local  # noqa: E402
+from jwt_authx import auth, token_cache, Principal  # noqa: E402
+from cache import response_cache  # noqa: E402
+from main import app, limiter, POST_COLUMNS, PAGE_SIZE, fan_out_post, feed_query  # noqa: E402
+from search import match_expression, search_query, rebuild_search_index  # noqa: E402
+from jobs import job_queue  # noqa: E402
+from likes import like_buffer  # noqa: E402
+from schemas import PostResponseSchema, PostPageSchema, post_list_adapter  # noqa: E402
+import passwords  # noqa: E402
+
+POSTS = [100, 1000, 5000]
+LIKES_PER_POST = 10
+LOGIN_USERS = 50
+LOGIN_ROUNDS = 4
+SERIALIZE_ROWS = 10000
+SERIALIZE_ROUNDS = 5
+FEED_POSTS = [1000, 10000]
+FEED_USERS = 1000
+FEED_INTERESTS = 5
+FEED_ROUNDS = 200
+SEARCH_POSTS = [10000, 100000]
+SEARCH_VOCABULARY = 20000
+SEARCH_ROUNDS = 200
+HOT_POST_LIKES = 3000
+PASSWORD = 'password'
+STATEMENT_TOLERANCE = 0.1
+
+# statements are attributed to the request task that issued them
+statement_count = contextvars.ContextVar('statement_count', default=None)
+
+
+def count_statement(*args):  # noqa
+    counter = statement_count.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+async def reset_database():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    token_cache.clear()
+    response_cache.clear()
+
+
+async def seed(posts: int, likes_per_post: int, comments_per_post: int = 0, users: int = 0, spare_users: int = 0):
+    # user1 is the admin, posts are authored round robin, like/comment n of a post is by user n
+    users = max(users, likes_per_post, comments_per_post, 1)
+    password_hash = await passwords.hash_password(PASSWORD)
+    await reset_database()
+    async with session_local() as session:
+        await session.execute(insert(UserModel), [
+            {'username': f'user{i}', 'password': password_hash, 'bio': '', 'age': 0,
+             'role': 'admin' if i == 1 else 'user'}
+            for i in range(1, users + spare_users + 1)
+        ])
+        await session.execute(insert(PostModel), [
+            {'author_id': i % users + 1, 'title': f'post {i}', 'body': 'body', 'like_count': likes_per_post,
+             'comment_count': comments_per_post}
+            for i in range(posts)
+        ])
+        if likes_per_post:
+            await session.execute(insert(LikeModel), [
+                {'post_id': post_id, 'author_id': author_id}
+                for post_id in range(1, posts + 1)
+                for author_id in range(1, likes_per_post + 1)
+            ])
+        if comments_per_post:
+            await session.execute(insert(CommentModel), [
+                {'post_id': post_id, 'author_id': author_id, 'title': 'comment'}
+                for post_id in range(1, posts + 1)
+                for author_id in range(1, comments_per_post + 1)
+            ])
+        await session.commit()
+
+
+def client_for(headers: dict = None) -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://bench', headers=headers)
+
+
+def bearer(uid: int, role: str = 'user') -> dict:
+    return {'Authorization': f'Bearer {auth.create_access_token(uid=str(uid), data={"role": role})}'}
+
+
+def percentile(samples: list, p: float) -> float:
+    if len(samples) < 2:
+        return samples[0] if samples else 0.0
+    return statistics.quantiles(samples, n=100, method='inclusive')[int(p) - 1]
+
+
+async def timed(client: httpx.AsyncClient, samples: list, method: str, url: str, **kwargs):
+    start = time.perf_counter()
+    response = await client.request(method, url, **kwargs)
+    samples.append((time.perf_counter() - start) * 1000)
+    response.raise_for_status()
+
+
+async def bench_get_posts(args):  # noqa
+    print(f'{"posts":>8} {"likes":>8} {"statements":>11} {"ms":>10}')
+    async with client_for(bearer(1)) as client:
+        for posts in POSTS:
+            await seed(posts, LIKES_PER_POST)
+            counter = [0]
+            statement_count.set(counter)
+            start = time.perf_counter()
+            response = await client.get('/posts')
+            elapsed = (time.perf_counter() - start) * 1000
+            response.raise_for_status()
+            print(f'{posts:>8} {posts * LIKES_PER_POST:>8} {counter[0]:>11} {elapsed:>10.1f}')
+
+
+async def bench_login(args):  # noqa
+    await seed(1, 0, users=LOGIN_USERS)
+    print(f'{"offload":>8} {"login p50":>10} {"login p99":>10} {"read p50":>10} {"read p99":>10}')
+    async with client_for(bearer(1)) as client:
+        for offload in (False, True):
+            passwords.offload = offload
+            logins, reads = [], []
+            for _ in range(LOGIN_ROUNDS):
+                await asyncio.gather(*(
+                    timed(client, logins, 'POST', '/login', json={'username': f'user{i}', 'password': PASSWORD})
+                    for i in range(1, LOGIN_USERS + 1)
+                ), *(
+                    timed(client, reads, 'GET', '/posts/1') for _ in range(LOGIN_USERS)
+                ))
+            print(f'{str(offload):>8} {percentile(logins, 50):>10.1f} {percentile(logins, 99):>10.1f} '
+                  f'{percentile(reads, 50):>10.1f} {percentile(reads, 99):>10.1f}')
+    passwords.offload = True
+
+
+async def serialize_entities(session) -> bytes:
+    result = await session.execute(select(PostModel))
+    items = []
+    for post in result.scalars().all():
+        items.append(PostResponseSchema(
+            post_id=post.id, author_id=post.author_id, title=post.title, body=post.body, likes=post.like_count
+        ))
+    return PostPageSchema(items=items, next_cursor=None).model_dump_json().encode()
+
+
+async def serialize_rows(session) -> bytes:
+    result = await session.execute(select(*POST_COLUMNS))
+    items = post_list_adapter.validate_python(result.all(), from_attributes=True)
+    return PostPageSchema(items=items, next_cursor=None).model_dump_json().encode()
+
+
+async def bench_serialize(args):  # noqa
+    await seed(SERIALIZE_ROWS, 0)
+    print(f'{"mode":>10} {"rows":>8} {"best ms":>10}')
+    for name, serialize in (('entities', serialize_entities), ('rows', serialize_rows)):
+        timings = []
+        for _ in range(SERIALIZE_ROUNDS):
+            async with session_local() as session:
+                start = time.perf_counter()
+                await serialize(session)
+                timings.append((time.perf_counter() - start) * 1000)
+        print(f'{name:>10} {SERIALIZE_ROWS:>8} {min(timings):>10.1f}')
+
+
+def assembled_feed_query(user_id: int, limit: int):
+    liked = select(PostModel.author_id).join(LikeModel, LikeModel.post_id == PostModel.id) \
+        .where(LikeModel.author_id == user_id)
+    commented = select(PostModel.author_id).join(CommentModel, CommentModel.post_id == PostModel.id) \
+        .where(CommentModel.author_id == user_id)
+    authors = select(literal(user_id)).union(liked, commented)
+    return select(*POST_COLUMNS).where(PostModel.author_id.in_(authors)).order_by(PostModel.id.desc()).limit(limit + 1)
+
+
+async def bench_feed(args):
+    # every user likes the first post of a few random authors, which puts them in those authors' audience
+    rng = random.Random(args.seed)
+    print(f'{"posts":>8} {"fan-out ms":>11} {"feed ms":>10} {"assembled ms":>13}')
+    for posts in FEED_POSTS:
+        await seed(posts, 0, users=FEED_USERS)
+        async with session_local() as session:
+            await session.execute(insert(LikeModel), [
+                {'post_id': author_id, 'author_id': user_id}
+                for user_id in range(1, FEED_USERS + 1)
+                for author_id in rng.sample(range(1, FEED_USERS + 1), FEED_INTERESTS)
+            ])
+            start = time.perf_counter()
+            for post_id in range(1, posts + 1):
+                await fan_out_post(session, post_id, (post_id - 1) % FEED_USERS + 1)
+            fan_out = (time.perf_counter() - start) * 1000 / posts
+            await session.commit()
+
+        timings = {}
+        for name, make_query in (('feed', lambda user_id, limit: feed_query(user_id, limit, None)),
+                                 ('assembled', assembled_feed_query)):
+            async with session_local() as session:
+                start = time.perf_counter()
+                for _ in range(FEED_ROUNDS):
+                    user_id = rng.randint(1, FEED_USERS)
+                    (await session.execute(make_query(user_id, PAGE_SIZE))).all()
+                timings[name] = (time.perf_counter() - start) * 1000 / FEED_ROUNDS
+        print(f'{posts:>8} {fan_out:>11.2f} {timings["feed"]:>10.2f} {timings["assembled"]:>13.2f}')
+
+
+async def bench_search(args):
+    # word frequencies follow a Zipf-like curve, queries mix common and rare words
+    rng = random.Random(args.seed)
+    vocabulary = [f'w{i}' for i in range(SEARCH_VOCABULARY)]
+    cum_weights = list(itertools.accumulate(1 / (i + 1) for i in range(SEARCH_VOCABULARY)))
+
+    def words(count: int) -> str:
+        return ' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=count))
+
+    print(f'{"posts":>8} {"index ms":>10} {"1 word ms":>10} {"2 words ms":>11} {"prefix ms":>10}')
+    for posts in SEARCH_POSTS:
+        await reset_database()
+        async with session_local() as session:
+            await session.execute(insert(PostModel), [
+                {'author_id': 1, 'title': words(5), 'body': words(30), 'like_count': 0, 'comment_count': 0}
+                for _ in range(posts)
+            ])
+            start = time.perf_counter()
+            await rebuild_search_index(session)
+            await session.commit()
+            indexing = (time.perf_counter() - start) * 1000
+
+        timings = []
+        for make_query in (lambda: rng.choice(vocabulary), lambda: words(2), lambda: rng.choice(vocabulary)[:4] + '*'):
+            async with session_local() as session:
+                start = time.perf_counter()
+                for _ in range(SEARCH_ROUNDS):
+                    (await session.execute(search_query(match_expression(make_query()), PAGE_SIZE, 0))).all()
+                timings.append((time.perf_counter() - start) * 1000 / SEARCH_ROUNDS)
+        print(f'{posts:>8} {indexing:>10.0f} {timings[0]:>10.2f} {timings[1]:>11.2f} {timings[2]:>10.2f}')
+
+
+async def bench_hot_post(args):
+    # every user likes the same post at once, with the likes written directly and through the buffer
+    print(f'{"mode":>8} {"rps":>8} {"p50 ms":>8} {"p99 ms":>8} {"likes":>6} {"errors":>7} {"flushes":>8}')
+    for buffered in (False, True):
+        await seed(1, 0, users=HOT_POST_LIKES)
+        tokens = []
+        for uid in range(1, HOT_POST_LIKES + 1):
+            headers = bearer(uid)
+            token_cache.put(headers['Authorization'].split()[1], Principal(user_id=uid, role='user'), float('inf'))
+            tokens.append(headers)
+        like_buffer.enabled = buffered
+        flushes = like_buffer.flushes
+        latencies, errors = [], [0]
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def like(client: httpx.AsyncClient, headers: dict):
+            # lock timeouts under contention are what is being measured, so they are counted, not raised
+            async with semaphore:
+                try:
+                    await timed(client, latencies, 'POST', '/likes', params={'post_id': 1}, headers=headers)
+                except Exception:  # noqa
+                    errors[0] += 1
+
+        async with client_for() as client:
+            start = time.perf_counter()
+            await asyncio.gather(*(like(client, headers) for headers in tokens))
+            await like_buffer.stop()
+            elapsed = time.perf_counter() - start
+        async with session_local() as session:
+            likes = (await session.execute(select(PostModel.like_count).where(PostModel.id == 1))).scalar()
+        print(f'{"buffered" if buffered else "direct":>8} {HOT_POST_LIKES / elapsed:>8.0f} '
+              f'{percentile(latencies, 50):>8.2f} {percentile(latencies, 99):>8.2f} {likes:>6} {errors[0]:>7} '
+              f'{like_buffer.flushes - flushes:>8}')
+    like_buffer.enabled = False
+
+
+def load_routes(args) -> list:
+    # Reads and new likes/comments go to the first half of the posts and deletes to the second
+    # half, so the destructive routes never turn reads into 404s. Deleted users come from the
+    # spare users, who have no posts, and their deletion jobs are what GET /jobs reads.
+    # /admin/drop_and_create_database is left out: it would wipe the dataset mid-run.
+    rng = random.Random(args.seed)
+    users, posts = args.users, args.posts
+    head, tail = list(range(1, posts // 2 + 1)), list(range(posts // 2 + 1, posts + 1))
+    rng.shuffle(tail)
+    spare_users = iter(range(users + 1, users + 2 * args.requests + 1))
+    new_users = iter(range(10 ** 9))
+
+    def reader():
+        return bearer(rng.randint(1, users))
+
+    def admin():
+        return bearer(1, 'admin')
+
+    def doomed_post():
+        return tail.pop() if tail else rng.choice(head)
+
+    def doomed_like(as_admin: bool):
+        post_id, author_id = doomed_post(), rng.randint(1, args.likes)
+        headers = admin() if as_admin else bearer(author_id)
+        return headers, {'params': {'like_id': (post_id - 1) * args.likes + author_id}}
+
+    def doomed_comment(as_admin: bool):
+        post_id, author_id = doomed_post(), rng.randint(1, args.comments)
+        headers = admin() if as_admin else bearer(author_id)
+        return headers, {'params': {'comment_id': (post_id - 1) * args.comments + author_id}}
+
+    def delete_post():
+        post_id = doomed_post()
+        return bearer((post_id - 1) % users + 1), {'params': {'post_id': post_id}}
+
+    return [
+        ('POST', '/register', lambda: (None, {'json': {
+            'username': f'bench{next(new_users)}', 'password': PASSWORD, 'bio': '', 'age': 0
+        }})),
+        ('POST', '/login', lambda: (None, {'json': {'username': f'user{rng.randint(1, users)}', 'password': PASSWORD}})),
+        ('GET', '/users', lambda: (reader(), {'params': {'after': rng.randint(0, users)}})),
+        ('GET', '/users/{user_id}', lambda: (reader(), {'url': f'/users/{rng.randint(1, users)}'})),
+        ('POST', '/posts', lambda: (reader(), {'json': {'title': 'bench', 'body': 'bench'}})),
+        ('GET', '/posts', lambda: (reader(), {'params': {'after': rng.choice(head)}})),
+        ('GET', '/posts/{post_id}', lambda: (reader(), {'url': f'/posts/{rng.choice(head)}'})),
+        ('GET', '/feed', lambda: (reader(), {})),
+        ('GET', '/search', lambda: (reader(), {'params': {'q': f'post {rng.choice(head)}'}})),
+        ('POST', '/likes', lambda: (reader(), {'params': {'post_id': rng.choice(head)}})),
+        ('POST', '/likes/batch', lambda: (reader(), {'json': {'post_ids': rng.sample(head, 10)}})),
+        ('GET', '/likes', lambda: (reader(), {'params': {'post_id': rng.choice(head)}})),
+        ('POST', '/comments', lambda: (reader(), {'json': {'post_id': rng.choice(head), 'title': 'bench'}})),
+        ('POST', '/comments/batch', lambda: (reader(), {'json': {'comments': [
+            {'post_id': post_id, 'title': 'bench'} for post_id in rng.sample(head, 10)
+        ]}})),
+        ('GET', '/comments', lambda: (reader(), {'params': {'post_id': rng.choice(head)}})),
+        ('DELETE', '/likes', lambda: doomed_like(False)),
+        ('DELETE', '/comments', lambda: doomed_comment(False)),
+        ('DELETE', '/admin/delete_like', lambda: doomed_like(True)),
+        ('DELETE', '/admin/delete_comment', lambda: doomed_comment(True)),
+        ('GET', '/admin/cache_stats', lambda: (admin(), {})),
+        ('POST', '/admin/recount_posts', lambda: (admin(), {})),
+        ('DELETE', '/posts', delete_post),
+        ('DELETE', '/users', lambda: (bearer(next(spare_users)), {})),
+        ('DELETE', '/admin/delete_user', lambda: (admin(), {'params': {'user_id': next(spare_users)}})),
+        ('GET', '/jobs/{job_id}', lambda: (admin(), {'url': f'/jobs/{rng.randint(1, 2 * args.requests)}'})),
+        ('POST', '/admin/rebuild_search', lambda: (admin(), {})),
+        ('GET', '/metrics', lambda: (None, {})),
+    ]
+
+
+async def run_route(client: httpx.AsyncClient, method: str, path: str, make_request, args) -> dict:
+    semaphore = asyncio.Semaphore(args.concurrency)
+    requests = [make_request() for _ in range(args.requests)]
+    latencies, statements, statuses = [], [], {}
+
+    async def send(headers: dict, kwargs: dict):
+        kwargs = dict(kwargs)
+        url = kwargs.pop('url', path)
+        async with semaphore:
+            counter = [0]
+            statement_count.set(counter)
+            start = time.perf_counter()
+            response = await client.request(method, url, headers=headers, **kwargs)
+            latencies.append((time.perf_counter() - start) * 1000)
+        statements.append(counter[0])
+        status = str(response.status_code)
+        statuses[status] = statuses.get(status, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(send(headers, kwargs) for headers, kwargs in requests))
+    elapsed = time.perf_counter() - start
+    return {
+        'requests': len(latencies),
+        'errors': sum(count for status, count in statuses.items() if int(status) >= 500),
+        'status': statuses,
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'statements_per_request': round(statistics.mean(statements), 2),
+    }
+
+
+def find_regressions(baseline: dict, results: dict, latency_tolerance: float) -> list:
+    regressions = []
+    for endpoint, before in baseline['endpoints'].items():
+        after = results['endpoints'].get(endpoint)
+        if after is None:
+            regressions.append(f'{endpoint}: not measured')
+            continue
+        # concurrent cache misses make statement counts vary a little between runs, an N+1 does not
+        if after['statements_per_request'] > before['statements_per_request'] * (1 + STATEMENT_TOLERANCE):
+            regressions.append(f'{endpoint}: statements per request '
+                               f'{before["statements_per_request"]} -> {after["statements_per_request"]}')
+        if after['p95_ms'] > before['p95_ms'] * (1 + latency_tolerance):
+            regressions.append(f'{endpoint}: p95 {before["p95_ms"]} ms -> {after["p95_ms"]} ms')
+        if after['errors'] > before['errors']:
+            regressions.append(f'{endpoint}: errors {before["errors"]} -> {after["errors"]}')
+    return regressions
+
+
+async def bench_load(args):
+    await seed(args.posts, args.likes, args.comments, users=args.users, spare_users=2 * args.requests)
+    config = {key: getattr(args, key) for key in ('users', 'posts', 'likes', 'comments', 'requests', 'concurrency', 'seed')}
+    results = {'config': config, 'endpoints': {}}
+
+    print(f'{"endpoint":<32} {"rps":>8} {"p50":>8} {"p95":>8} {"p99":>8} {"sql":>6}  status')
+    async with client_for() as client:
+        for method, path, make_request in load_routes(args):
+            stats = await run_route(client, method, path, make_request, args)
+            # keep background cascades from bleeding into the next endpoint's numbers
+            await job_queue.join()
+            results['endpoints'][f'{method} {path}'] = stats
+            print(f'{method + " " + path:<32} {stats["throughput_rps"]:>8} {stats["p50_ms"]:>8} {stats["p95_ms"]:>8} '
+                  f'{stats["p99_ms"]:>8} {stats["statements_per_request"]:>6}  {stats["status"]}')
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if baseline['config'] != config:
+            print(f'baseline was recorded with {baseline["config"]}')
+            sys.exit(2)
+        regressions = find_regressions(baseline, results, args.latency_tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+
+
+BENCHMARKS = {
+    'posts': bench_get_posts,
+    'login': bench_login,
+    'serialize': bench_serialize,
+    'feed': bench_feed,
+    'search': bench_search,
+    'hot_post': bench_hot_post,
+    'load': bench_load,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark', help=', '.join(BENCHMARKS))
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--posts', type=int, default=2000)
+    parser.add_argument('--likes', type=int, default=10, help='likes per post')
+    parser.add_argument('--comments', type=int, default=5, help='comments per post')
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the load results to this JSON file')
+    parser.add_argument('--compare', help='JSON baseline to compare the load results against')
+    parser.add_argument('--latency-tolerance', type=float, default=1.0, help='allowed relative p95 growth')
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f'unknown benchmark {name}')
+    if not 1 <= max(args.likes, args.comments) <= args.users or min(args.likes, args.comments) < 1 or args.posts < 40:
+        parser.error('load needs 40+ posts and 1 to --users likes and comments per post')
+    return args
+
+
+def main():
+    args = parse_args()
+    limiter.enabled = False
+    event.listen(engine.sync_engine, 'before_cursor_execute', count_statement)
+    for name in args.benchmarks or BENCHMARKS:
+        print(f'== {name}')
+        asyncio.run(BENCHMARKS[name](args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+import os
+import time
+from collections import OrderedDict
+
+from invalidation import invalidation_bus
+
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 10000))
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', 30))
+
+MISSING = object()
+
+
+class LRUCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._keys_by_tag = {}
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] <= time.time():
+            self.delete(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return MISSING
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key, value, expires_at: float = None, tags: tuple = ()):
+        if expires_at is None:
+            expires_at = time.time() + self.ttl
+        self.delete(key)
+        self._entries[key] = (expires_at, value, tags)
+        for tag in tags:
+            self._keys_by_tag.setdefault(tag, set()).add(key)
+        while len(self._entries) > self.maxsize:
+            self.delete(next(iter(self._entries)))
+
+    def delete(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self._keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_tag[tag]
+
+    def delete_tag(self, tag):
+        for key in list(self._keys_by_tag.get(tag, ())):
+            self.delete(key)
+
+    def clear(self):
+        self._entries.clear()
+        self._keys_by_tag.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+response_cache = LRUCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+
+def user_key(user_id: int):
+    return 'user', int(user_id)
+
+
+def post_key(post_id: int):
+    return 'post', int(post_id)
+
+
+def version_key(post_id: int):
+    return 'version', int(post_id)
+
+
+def likes_tag(post_id: int):
+    return 'likes', int(post_id)
+
+
+def likes_key(post_id: int, after, limit: int):
+    return 'likes', int(post_id), after, limit
+
+
+def comments_tag(post_id: int):
+    return 'comments', int(post_id)
+
+
+def comments_key(post_id: int, after, limit: int):
+    return 'comments', int(post_id), after, limit
+
+
+def evict_user(user_id: int):
+    invalidation_bus.publish('user', int(user_id))
+
+
+def evict_posts(*post_ids: int, likes: bool = True, comments: bool = True):
+    if post_ids:
+        invalidation_bus.publish_keys('posts', [int(post_id) for post_id in post_ids], likes, comments)
+
+
+def clear_responses():
+    invalidation_bus.publish('responses')
+
+
+def clear_caches():
+    # the token cache subscribes to 'clear' as well
+    invalidation_bus.publish('clear')
+
+
+@invalidation_bus.handler('user')
+def _evict_user(user_id: int):
+    response_cache.delete(user_key(user_id))
+
+
+@invalidation_bus.handler('posts')
+def _evict_posts(post_ids: list, likes: bool, comments: bool):
+    for post_id in post_ids:
+        response_cache.delete(post_key(post_id))
+        response_cache.delete(version_key(post_id))
+        if likes:
+            response_cache.delete_tag(likes_tag(post_id))
+        if comments:
+            response_cache.delete_tag(comments_tag(post_id))
+
+
+@invalidation_bus.handler('responses')
+@invalidation_bus.handler('clear')
+def _clear_responses():
+    response_cache.clear()
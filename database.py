@@ -1,15 +1,184 @@
+import asyncio
+import itertools
+import logging
+import os
+import time
+
+import jwt
+from fastapi import Request
+from sqlalchemy import event, text
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
-SQL_DB_URL = 'sqlite+aiosqlite:///database.db'
+from invalidation import invalidation_bus
+
+logger = logging.getLogger('uvicorn.error')
+
+SQL_DB_URL = os.getenv('DATABASE_URL', 'sqlite+aiosqlite:///database.db')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', '1') == '1'
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', 256))
+SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000))
+SQLITE_CACHE_SIZE = int(os.getenv('SQLITE_CACHE_SIZE', -64000))
+# comma separated replica urls; for sqlite, SQLITE_READ_ENGINES opens the primary file that many times read-only
+DATABASE_READ_URLS = [url.strip() for url in os.getenv('DATABASE_READ_URLS', '').split(',') if url.strip()]
+SQLITE_READ_ENGINES = int(os.getenv('SQLITE_READ_ENGINES', 0))
+READ_YOUR_WRITES_WINDOW = float(os.getenv('READ_YOUR_WRITES_WINDOW', 2))
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def create_engine_from_config(url: str, read_only: bool = False):
+    if url.startswith('sqlite'):
+        # aiosqlite runs every connection on its own thread, so a small pool of long-lived connections is enough
+        engine = create_async_engine(
+            url,
+            connect_args={'check_same_thread': False, 'timeout': SQLITE_BUSY_TIMEOUT / 1000},
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+        )
+        event.listen(engine.sync_engine, 'connect', set_sqlite_pragmas)
+        if read_only:
+            event.listen(engine.sync_engine, 'connect', set_sqlite_query_only)
+        return engine
+
+    return create_async_engine(
+        url,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        connect_args={'prepared_statement_cache_size': DB_STATEMENT_CACHE_SIZE},
+    )
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):  # noqa
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f'PRAGMA journal_mode={SQLITE_JOURNAL_MODE}')
+    cursor.execute(f'PRAGMA synchronous={SQLITE_SYNCHRONOUS}')
+    cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}')
+    cursor.execute(f'PRAGMA cache_size={SQLITE_CACHE_SIZE}')
+    cursor.close()
+
 
-engine = create_async_engine(SQL_DB_URL, connect_args={'check_same_thread': False})
+def set_sqlite_query_only(dbapi_connection, connection_record):  # noqa
+    # WAL readers never block the writer and see every committed transaction
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA query_only=1')
+    cursor.close()
+
+
+engine = create_engine_from_config(SQL_DB_URL)
+
+insert = postgresql.insert if engine.dialect.name == 'postgresql' else sqlite.insert
 
 session_local = async_sessionmaker(engine, expire_on_commit=False)
 
+if not DATABASE_READ_URLS and SQL_DB_URL.startswith('sqlite'):
+    DATABASE_READ_URLS = [SQL_DB_URL] * SQLITE_READ_ENGINES
+read_engines = [create_engine_from_config(url, read_only=True) for url in DATABASE_READ_URLS]
+# sqlite read engines open the primary's own file, only real replicas can lag behind it
+read_session_makers = [
+    async_sessionmaker(read_engine, expire_on_commit=False, info={'replica': url != SQL_DB_URL})
+    for url, read_engine in zip(DATABASE_READ_URLS, read_engines)
+]
+read_sessions = itertools.cycle(read_session_makers)
+
 Base = declarative_base()
 
 
-async def get_sessions():
+def read_session_local():
+    # round robin over the read engines, the primary when there are none
+    return next(read_sessions)() if read_engines else session_local()
+
+
+# user id -> time until which the user's reads go to the primary, shared by the workers through the bus
+sticky_until = {}
+
+
+@invalidation_bus.handler('sticky')
+def _stick_to_primary(user_id: int, until: float):
+    if len(sticky_until) > 10000:
+        now = time.time()
+        for key in [key for key, value in sticky_until.items() if value <= now]:
+            del sticky_until[key]
+    sticky_until[user_id] = max(until, sticky_until.get(user_id, 0))
+
+
+def stick_to_primary(user_id: int):
+    if read_engines:
+        invalidation_bus.publish('sticky', int(user_id), time.time() + READ_YOUR_WRITES_WINDOW)
+
+
+def request_user_id(request: Request):
+    # only picks the engine, the signature is checked by the auth dependency
+    header = request.headers.get('authorization', '')
+    if not header.lower().startswith('bearer '):
+        return None
+    try:
+        return int(jwt.decode(header[7:], options={'verify_signature': False})['sub'])
+    except (jwt.PyJWTError, KeyError, ValueError):
+        return None
+
+
+def request_session(request: Request):
+    # safe methods read from a replica unless the caller wrote something in the last few seconds
+    user_id = request_user_id(request) if read_engines else None
+    if request.method in SAFE_METHODS and sticky_until.get(user_id, 0) <= time.time():
+        return read_session_local()
+    if user_id is not None and request.method not in SAFE_METHODS:
+        stick_to_primary(user_id)
+    return session_local()
+
+
+async def get_sessions(request: Request):
+    async with request_session(request) as session:
+        yield session
+
+
+def is_replica(session) -> bool:
+    # rows read from a replica may be older than the last write, they must not be cached beyond the request
+    return session.info.get('replica', False)
+
+
+async def get_primary_session():
     async with session_local() as session:
         yield session
+
+
+async def check_database() -> dict:
+    settings = {
+        'url': engine.url.render_as_string(hide_password=True),
+        'pool': type(engine.pool).__name__,
+        'pool_size': engine.pool.size(),
+        'max_overflow': DB_MAX_OVERFLOW,
+    }
+    async with engine.connect() as conn:
+        await conn.execute(text('SELECT 1'))
+        if engine.dialect.name == 'sqlite':
+            for pragma in ('journal_mode', 'synchronous', 'busy_timeout', 'cache_size'):
+                settings[pragma] = (await conn.execute(text(f'PRAGMA {pragma}'))).scalar()
+        else:
+            settings['pool_pre_ping'] = DB_POOL_PRE_PING
+            settings['statement_cache_size'] = DB_STATEMENT_CACHE_SIZE
+    settings['read_engines'] = len(read_engines)
+    logger.info('Database settings: %s', settings)
+    return settings
+
+
+async def warm_pool() -> int:
+    # every connection is opened and configured now instead of during the first requests
+    async def ping(pool_engine):
+        async with pool_engine.connect() as conn:
+            await conn.execute(text('SELECT 1'))
+            await asyncio.sleep(0)
+
+    await asyncio.gather(*(
+        ping(pool_engine) for pool_engine in (engine, *read_engines) for _ in range(pool_engine.pool.size())
+    ))
+    return sum(pool_engine.pool.checkedin() for pool_engine in (engine, *read_engines))
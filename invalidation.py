@@ -0,0 +1,217 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import tempfile
+import time
+from collections import deque
+from urllib.parse import urlparse
+
+logger = logging.getLogger('uvicorn.error')
+
+INVALIDATION_BUS_URI = os.getenv(
+    'INVALIDATION_BUS_URI', f'unix://{tempfile.gettempdir()}/fastapi-second-steps-invalidation'
+)
+# messages waiting for a peer that doesn't drain its socket; past this the oldest are dropped and the peer
+# relies on the cache TTLs for them
+MAX_PENDING_PER_PEER = 1000
+MAX_KEYS_PER_MESSAGE = 1000
+# workers announce themselves when they start, the directory is listed again at most this often as a fallback
+PEER_RESCAN_INTERVAL = 5.0
+
+
+class Peer:
+    # a socket connected to one worker: unlike an unconnected one, it only polls writable when that worker's
+    # queue has room, so add_writer wakes up exactly when the backlog can be sent
+    def __init__(self, path: str):
+        self.path = path
+        self.pending = deque()
+        self.waiting = False
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        try:
+            self.socket.connect(path)
+        except OSError:
+            self.socket.close()
+            raise
+
+    def close(self):
+        if self.waiting:
+            asyncio.get_running_loop().remove_writer(self.socket.fileno())
+            self.waiting = False
+        self.socket.close()
+
+
+# Every worker process on the host binds a unix datagram socket in one directory. A publish applies the
+# eviction locally and sends it to every other socket found there; peers evict as soon as their event loop
+# reads the datagram. Sends never block the event loop: a message a peer has no room for waits in a bounded
+# per-peer queue until the peer's socket is writable again. Until start() is called, or with a memory:// uri,
+# evictions stay in this process.
+class InvalidationBus:
+    def __init__(self, uri: str):
+        parsed = urlparse(uri)
+        self.directory = parsed.path if parsed.scheme == 'unix' else None
+        self.handlers = {}
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+        self._socket = None
+        self._path = None
+        self._peers = {}
+        self._scanned_at = 0.0
+
+    def handler(self, kind: str):
+        def register(func):
+            self.handlers.setdefault(kind, []).append(func)
+            return func
+        return register
+
+    def _apply(self, kind: str, args: list):
+        for func in self.handlers.get(kind, ()):
+            func(*args)
+
+    async def start(self):
+        if self.directory is None or self._socket is not None:
+            return
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        self._path = os.path.join(self.directory, f'{os.getpid()}.sock')
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(self._path)
+        self._socket.setblocking(False)
+        asyncio.get_running_loop().add_reader(self._socket.fileno(), self._receive)
+        self._broadcast(json.dumps(['_join', [self._path]]).encode())
+
+    async def stop(self):
+        if self._socket is None:
+            return
+        self._broadcast(json.dumps(['_leave', [self._path]]).encode())
+        for peer in list(self._peers.values()):
+            peer.close()
+        self._peers = {}
+        asyncio.get_running_loop().remove_reader(self._socket.fileno())
+        self._socket.close()
+        self._socket = None
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+
+    def publish(self, kind: str, *args):
+        self._apply(kind, list(args))
+        if self._socket is not None:
+            self._broadcast(json.dumps([kind, list(args)]).encode())
+
+    def publish_keys(self, kind: str, keys: list, *args):
+        # keeps datagrams well below the socket buffer size for large evictions
+        for start in range(0, len(keys), MAX_KEYS_PER_MESSAGE):
+            self.publish(kind, keys[start:start + MAX_KEYS_PER_MESSAGE], *args)
+
+    def _broadcast(self, message: bytes):
+        now = time.monotonic()
+        if now - self._scanned_at >= PEER_RESCAN_INTERVAL:
+            self._scanned_at = now
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if name.endswith('.sock') and path != self._path:
+                    self._add_peer(path)
+        for peer in list(self._peers.values()):
+            self._send(peer, message)
+
+    def _add_peer(self, path: str):
+        if path in self._peers:
+            return
+        try:
+            self._peers[path] = Peer(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            self._remove_peer(path, stale=True)
+        except OSError as e:
+            logger.warning('invalidation peer %s unreachable: %s', path, e)
+
+    def _remove_peer(self, path: str, stale: bool = False):
+        peer = self._peers.pop(path, None)
+        if peer is not None:
+            self.dropped += len(peer.pending)
+            peer.close()
+        if stale:
+            # the worker is gone without cleaning up after itself
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def _send(self, peer: Peer, message: bytes):
+        if peer.pending:
+            self._enqueue(peer, message)
+            return
+        try:
+            peer.socket.send(message)
+        except BlockingIOError:
+            self._enqueue(peer, message)
+        except (ConnectionRefusedError, FileNotFoundError):
+            # the worker closed its socket; the next scan reconnects if the path has a new owner
+            self._remove_peer(peer.path)
+        except OSError as e:
+            self.dropped += 1
+            logger.warning('invalidation to %s dropped: %s', peer.path, e)
+        else:
+            self.sent += 1
+
+    def _enqueue(self, peer: Peer, message: bytes):
+        if len(peer.pending) >= MAX_PENDING_PER_PEER:
+            peer.pending.popleft()
+            self.dropped += 1
+        peer.pending.append(message)
+        if not peer.waiting:
+            peer.waiting = True
+            asyncio.get_running_loop().add_writer(peer.socket.fileno(), self._drain, peer)
+
+    def _drain(self, peer: Peer):
+        while peer.pending:
+            try:
+                peer.socket.send(peer.pending[0])
+            except BlockingIOError:
+                return
+            except (ConnectionRefusedError, FileNotFoundError):
+                self._remove_peer(peer.path)
+                return
+            except OSError as e:
+                logger.warning('invalidation to %s dropped: %s', peer.path, e)
+                self.dropped += 1
+            else:
+                self.sent += 1
+            peer.pending.popleft()
+        asyncio.get_running_loop().remove_writer(peer.socket.fileno())
+        peer.waiting = False
+
+    def _receive(self):
+        while True:
+            try:
+                data = self._socket.recv(65536)
+            except BlockingIOError:
+                return
+            self.received += 1
+            try:
+                kind, args = json.loads(data)
+                if kind == '_join':
+                    # a new worker may have reused the socket path of a dead one
+                    self._remove_peer(*args)
+                    self._add_peer(*args)
+                elif kind == '_leave':
+                    self._remove_peer(*args)
+                else:
+                    self._apply(kind, args)
+            except Exception:  # noqa
+                logger.exception('invalid invalidation message')
+
+    def stats(self) -> dict:
+        return {
+            'peers': len(self._peers),
+            'sent': self.sent,
+            'received': self.received,
+            'queued': sum(len(peer.pending) for peer in self._peers.values()),
+            'dropped': self.dropped,
+        }
+
+
+invalidation_bus = InvalidationBus(INVALIDATION_BUS_URI)
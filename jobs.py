@@ -0,0 +1,135 @@
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import time
+
+from sqlalchemy import select, update, func, or_, and_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import session_local
+from models import JobModel
+
+logger = logging.getLogger('uvicorn.error')
+
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+JOB_CHUNK_SIZE = int(os.getenv('JOB_CHUNK_SIZE', 500))
+# a running job whose worker hasn't finished a chunk for this long is considered abandoned
+JOB_CLAIM_TIMEOUT = float(os.getenv('JOB_CLAIM_TIMEOUT', 300))
+
+
+class Job:
+    def __init__(self, job_id: int, params: dict):
+        self.id = job_id
+        self.params = params
+
+    async def advance(self, session: AsyncSession, rows: int):
+        # runs in the chunk's transaction, so the progress only moves when the chunk commits
+        query = update(JobModel).where(JobModel.id == self.id) \
+            .values(progress=JobModel.progress + rows, claimed_at=time.time())
+        await session.execute(query)
+
+
+# Jobs are persisted before they are queued and picked up again on startup, so every handler has to be
+# safe to run twice: handlers work in small committed chunks and simply find less to do on a rerun.
+# Every worker process queues the unfinished jobs on startup; a job only runs in the one that claims it.
+class JobQueue:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.handlers = {}
+        self._queue = None
+        self._tasks = []
+
+    def handler(self, kind: str):
+        def register(func):
+            self.handlers[kind] = func
+            return func
+        return register
+
+    def _start_workers(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        while len(self._tasks) < self.workers:
+            # workers may be started from inside a request, they must not inherit its context variables
+            self._tasks.append(contextvars.Context().run(asyncio.create_task, self._work()))
+
+    async def start(self):
+        self._start_workers()
+        async with session_local() as session:
+            query = select(JobModel.id).where(JobModel.status.in_(('queued', 'running'))).order_by(JobModel.id)
+            result = await session.execute(query)
+            for job_id in result.scalars().all():
+                self._queue.put_nowait(job_id)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    async def join(self):
+        if self._queue is not None:
+            await self._queue.join()
+
+    # commits the caller's session, so the job is persisted atomically with whatever the caller changed
+    async def enqueue(self, session: AsyncSession, kind: str, owner_id: int = None, **params) -> int:
+        job = JobModel(kind=kind, params=json.dumps(params), owner_id=owner_id, status='queued', progress=0,
+                       created_at=time.time())
+        session.add(job)
+        await session.commit()
+        self._start_workers()
+        self._queue.put_nowait(job.id)
+        return job.id
+
+    async def _set_status(self, job_id: int, **values):
+        async with session_local() as session:
+            await session.execute(update(JobModel).where(JobModel.id == job_id).values(**values))
+            await session.commit()
+
+    async def _work(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            finally:
+                self._queue.task_done()
+
+    async def _claim(self, job_id: int):
+        now = time.time()
+        abandoned = and_(JobModel.status == 'running', func.coalesce(JobModel.claimed_at, 0) < now - JOB_CLAIM_TIMEOUT)
+        async with session_local() as session:
+            query = update(JobModel).where(JobModel.id == job_id, or_(JobModel.status == 'queued', abandoned)) \
+                .values(status='running', claimed_at=now)
+            result = await session.execute(query)
+            job = await session.get(JobModel, job_id)
+            await session.commit()
+        if not result.rowcount:
+            if job is not None and job.status == 'running':
+                # another worker claimed it recently, or one that died just before this process started:
+                # look again once the claim would count as abandoned
+                delay = (job.claimed_at or 0) + JOB_CLAIM_TIMEOUT - now
+                asyncio.get_running_loop().call_later(max(delay, 0) + 1, self._requeue, job_id)
+            return None
+        return job
+
+    def _requeue(self, job_id: int):
+        if self._queue is not None:
+            self._queue.put_nowait(job_id)
+
+    async def _run(self, job_id: int):
+        job = await self._claim(job_id)
+        if job is None:
+            return
+
+        try:
+            await self.handlers[job.kind](Job(job_id, json.loads(job.params)))
+        except Exception as e:
+            logger.exception('Job %s (%s) failed', job_id, job.kind)
+            await self._set_status(job_id, status='failed', error=str(e), finished_at=time.time())
+        else:
+            await self._set_status(job_id, status='done', finished_at=time.time())
+
+
+job_queue = JobQueue(JOB_WORKERS)
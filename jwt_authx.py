@@ -1,9 +1,18 @@
+import os
+import time
+from dataclasses import dataclass
+
 import jwt
 from jwt import PyJWTError
 from authx import AuthX, AuthXConfig
-from fastapi import HTTPException
+from fastapi import HTTPException, Request, Depends
 from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from models import UserModel
+from database import get_sessions, is_replica
+from cache import LRUCache, MISSING
+from invalidation import invalidation_bus
+from metrics import span
 
 config = AuthXConfig()
 config.JWT_SECRET_KEY = 'SECRET_KEY'
@@ -11,6 +20,46 @@ config.JWT_ACCESS_COOKIE_NAME = 'my_access_token'
 config.JWT_TOKEN_LOCATION = ['headers']
 auth = AuthX(config=config)
 
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 60
+# With the policy on, the signed role claim is trusted and a token costs no query at all, but a deleted
+# account keeps working until its token expires. Off, the user is loaded once per token and TTL, so a
+# role change only applies once the cached principal expires, up to TOKEN_CACHE_TTL seconds later.
+# Code that changes a user's role or deletes them has to call token_cache.invalidate_user to apply it
+# right away, as account deletion does.
+AUTH_TRUST_ROLE_CLAIM = os.getenv('AUTH_TRUST_ROLE_CLAIM', '0') == '1'
+JOB_TOKEN_TTL = 24 * 60 * 60
+
+
+@dataclass(frozen=True)
+class Principal:
+    user_id: int
+    role: str
+
+    @property
+    def is_admin(self) -> bool:
+        return self.role == 'admin'
+
+
+class TokenCache(LRUCache):
+    def put(self, token: str, principal: Principal, expires: float):
+        expires_at = min(time.time() + self.ttl, expires)
+        self.set(token, principal, expires_at, tags=(str(principal.user_id),))
+
+    def invalidate_user(self, uid):
+        invalidation_bus.publish('tokens', int(uid))
+
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+
+
+@invalidation_bus.handler('tokens')
+def _invalidate_user_tokens(uid: int):
+    token_cache.delete_tag(str(uid))
+
+
+invalidation_bus.handler('clear')(token_cache.clear)
+
 
 def get_payload_from_token(token: str):
     try:
@@ -20,16 +69,55 @@ def get_payload_from_token(token: str):
         raise HTTPException(401, detail="Invalid token")
 
 
-async def verify_token(token, session):
+# A job token lets the owner of a job read its status without an account, e.g. after deleting their own or
+# resetting the database. It names a single job and carries no subject, so it is never an access token.
+def create_job_token(job_id: int) -> str:
+    payload = {'job': job_id, 'exp': int(time.time()) + JOB_TOKEN_TTL}
+    return jwt.encode(payload, config.JWT_SECRET_KEY, algorithm=config.JWT_ALGORITHM)
+
+
+def verify_job_token(token: str, job_id: int):
+    payload = get_payload_from_token(token)
+    if payload.get('job') != job_id:
+        raise HTTPException(403, detail='This job is not yours')
+
+
+async def get_principal(request: Request, session: AsyncSession = Depends(get_sessions)) -> Principal:
+    with span('auth'):
+        return await _get_principal(request, session)
+
+
+async def _get_principal(request: Request, session: AsyncSession) -> Principal:
+    token = await auth.get_token_from_request(request)
+    if token is None:
+        raise HTTPException(401, detail='Missing token')
+    principal = token_cache.get(token.token)
+    if principal is not MISSING:
+        return principal
+
     try:
         auth.verify_token(token=token)
     except Exception as e:
         raise HTTPException(401, detail={"message": str(e)}) from e
 
-    uid = get_payload_from_token(token.token)['sub']
-    query = select(UserModel).where(UserModel.id == uid)
-    result = await session.execute(query)
-    user = result.scalar()
-    if not user:
-        raise HTTPException(status_code=404, detail='Invalid token')
-    return True
+    payload = get_payload_from_token(token.token)
+    if AUTH_TRUST_ROLE_CLAIM:
+        principal = Principal(user_id=int(payload['sub']), role=payload.get('role', 'user'))
+    else:
+        query = select(UserModel.id, UserModel.role).where(UserModel.id == int(payload['sub']))
+        result = await session.execute(query)
+        user = result.first()
+        if not user:
+            raise HTTPException(status_code=404, detail='Invalid token')
+        principal = Principal(user_id=user.id, role=user.role)
+        if is_replica(session):
+            # a replica may still have an account that was just deleted
+            return principal
+    token_cache.put(token.token, principal, payload.get('exp', float('inf')))
+    return principal
+
+
+async def get_admin(principal: Principal = Depends(get_principal)) -> Principal:
+    if not principal.is_admin:
+        raise HTTPException(status_code=403, detail='You are not admin')
+    return principal
@@ -0,0 +1,150 @@
+import asyncio
+import contextvars
+import logging
+import os
+from collections import Counter
+
+from cache import LRUCache, MISSING
+from invalidation import invalidation_bus
+
+logger = logging.getLogger('uvicorn.error')
+
+LIKE_BUFFER_ENABLED = os.getenv('LIKE_BUFFER_ENABLED', '0') == '1'
+LIKE_FLUSH_INTERVAL = float(os.getenv('LIKE_FLUSH_INTERVAL', 0.005))
+LIKE_BUFFER_SIZE = int(os.getenv('LIKE_BUFFER_SIZE', 5000))
+LIKER_SETS = int(os.getenv('LIKER_SETS', 1000))
+LIKER_SET_TTL = 300
+
+
+# Write-behind buffer for likes: requests only record (post_id, author_id) in memory and a single task
+# writes everything that arrived during the last interval in one transaction. Pending likes are lost if
+# the process dies before the flush, which is why the buffer is off by default. Duplicates are rejected
+# against the set of authors who liked the post, loaded once per post and kept up to date in memory.
+# Those sets only see this process's likes, so a like given through two workers at once is answered
+# twice with ok; the flush's ON CONFLICT DO NOTHING still stores and counts it once.
+class LikeBuffer:
+    def __init__(self, enabled: bool, interval: float, size: int):
+        self.enabled = enabled
+        self.interval = interval
+        self.size = size
+        self.flushes = 0
+        self.flushed = 0
+        self._flush = None
+        self._pending = set()
+        self._counts = Counter()
+        self._flushing = set()
+        self._flushing_counts = Counter()
+        self._wakeup = None
+        self._task = None
+        self.liker_sets = LRUCache(LIKER_SETS, LIKER_SET_TTL)
+
+    def flusher(self, func):
+        self._flush = func
+        return func
+
+    def is_pending(self, post_id: int, author_id: int) -> bool:
+        return (post_id, author_id) in self._pending or (post_id, author_id) in self._flushing
+
+    def likers(self, post_id: int):
+        likers = self.liker_sets.get(post_id)
+        return None if likers is MISSING else likers
+
+    def load_likers(self, post_id: int, author_ids) -> set:
+        likers = set(author_ids)
+        likers.update(uid for pending_post_id, uid in self._pending | self._flushing if pending_post_id == post_id)
+        self.liker_sets.set(post_id, likers)
+        return likers
+
+    def add_likers(self, post_ids, author_id: int):
+        # likes stored without the buffer
+        for post_id in post_ids:
+            likers = self.likers(post_id)
+            if likers is not None:
+                likers.add(author_id)
+
+    def forget_likers(self, post_ids: list):
+        for post_id in post_ids:
+            self.liker_sets.delete(post_id)
+
+    def add(self, post_id: int, author_id: int) -> bool:
+        if self.is_pending(post_id, author_id):
+            return False
+        likers = self.likers(post_id)
+        if likers is not None:
+            if author_id in likers:
+                return False
+            likers.add(author_id)
+        self._pending.add((post_id, author_id))
+        self._counts[post_id] += 1
+        self._start()
+        if len(self._pending) >= self.size:
+            self._wakeup.set()
+        return True
+
+    def pending_likes(self, post_id: int) -> int:
+        # likes stay visible while their flush is running, until the transaction is committed
+        return self._counts[post_id] + self._flushing_counts[post_id]
+
+    def _start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            # may be started from inside a request, the flusher must not inherit its context variables
+            self._task = contextvars.Context().run(asyncio.create_task, self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        self._flushing, self._pending = self._pending, set()
+        self._flushing_counts, self._counts = self._counts, Counter()
+        try:
+            await self._flush(self._flushing)
+        except BaseException as e:
+            # the likes are pending again, a retry can't count them twice because the insert ignores conflicts
+            self._pending |= self._flushing
+            self._counts.update(self._flushing_counts)
+            if not isinstance(e, Exception):
+                raise
+            logger.exception('Flushing %s likes failed, retrying', len(self._flushing))
+        else:
+            self.flushes += 1
+            self.flushed += len(self._flushing)
+        finally:
+            self._flushing = set()
+            self._flushing_counts = Counter()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'pending': len(self._pending),
+            'flushes': self.flushes,
+            'flushed': self.flushed,
+        }
+
+
+like_buffer = LikeBuffer(LIKE_BUFFER_ENABLED, LIKE_FLUSH_INTERVAL, LIKE_BUFFER_SIZE)
+
+
+def forget_likers(*post_ids: int):
+    # after likes were deleted, the sets are reloaded from the database on the next like
+    if post_ids:
+        invalidation_bus.publish_keys('likers', [int(post_id) for post_id in post_ids])
+
+
+invalidation_bus.handler('likers')(like_buffer.forget_likers)
+invalidation_bus.handler('clear')(like_buffer.liker_sets.clear)
@@ -1,33 +1,403 @@
 import uvicorn
-from fastapi import FastAPI, Depends, HTTPException, Request
-from typing import Annotated, List
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Depends, HTTPException, Request, Response, Query, Header
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from typing import Annotated, Optional, List
+from collections import Counter
 
-from sqlalchemy import select
+from sqlalchemy import select, func, update, delete, or_, literal, case, text
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
 
-from authx import RequestToken
-import hashlib
+import logging
 import os
+import time
 
 from slowapi import Limiter
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 from slowapi import _rate_limit_exceeded_handler
 
-from models import Base, UserModel, PostModel, LikeModel, CommentModel
+from models import Base, UserModel, PostModel, LikeModel, CommentModel, FeedEntryModel, JobModel
 from schemas import UserRegisterSchema, UserLoginSchema, UserResponseSchema, PostCreateSchema, PostResponseSchema, \
-                    CommentSchema, CommentResponseSchema, LikeResponseSchema
-from database import get_sessions, engine
-from jwt_authx import auth, get_payload_from_token, verify_token
-
-
-app = FastAPI()
-
-limiter = Limiter(key_func=get_remote_address)
+                    CommentSchema, UserPageSchema, PostPageSchema, \
+                    LikePageSchema, CommentPageSchema, LikeBatchSchema, CommentBatchSchema, BatchItemResultSchema, \
+                    SearchPageSchema, JobResponseSchema, user_list_adapter, post_list_adapter, like_list_adapter, comment_list_adapter, \
+                    search_list_adapter
+from database import get_sessions, get_primary_session, engine, read_engines, session_local, request_session, \
+    read_session_makers, insert, check_database, warm_pool, stick_to_primary, is_replica
+from jwt_authx import auth, get_payload_from_token, token_cache, Principal, get_principal, get_admin, \
+    create_job_token, verify_job_token
+from passwords import hash_password, verify_password
+from rate_limit import RATE_LIMIT_STORAGE_URI
+from search import SEARCH_ENABLED, match_expression, search_query, index_post, index_comments, unindex_posts, \
+                   unindex_comments, rebuild_search_index
+from jobs import job_queue, Job, JOB_CHUNK_SIZE
+from likes import like_buffer, forget_likers
+from metrics import METRICS_ENABLED, METRICS_CONTENT_TYPE, MetricsMiddleware, instrument_engine, render_metrics, \
+    set_gauge
+from migrations import migrate
+from cache import response_cache, MISSING, user_key, post_key, version_key, likes_key, likes_tag, comments_key, comments_tag, \
+                  evict_user, evict_posts, clear_responses, clear_caches
+from invalidation import invalidation_bus
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):  # noqa
+    started = time.perf_counter()
+    migrations = await migrate()
+    await check_database()
+    await invalidation_bus.start()
+    await job_queue.start()
+    warmed = await warm_up()
+    startup = time.perf_counter() - started
+    set_gauge('app_startup_seconds', 'Time the lifespan took before serving requests.', startup)
+    logger.info('Started in %.0f ms, migrations applied: %s, warmed up: %s', startup * 1000, migrations, warmed)
+    yield
+    await like_buffer.stop()
+    await job_queue.stop()
+    await invalidation_bus.stop()
+
+
+logger = logging.getLogger('uvicorn.error')
+
+app = FastAPI(lifespan=lifespan)
+
+limiter = Limiter(key_func=get_remote_address, storage_uri=RATE_LIMIT_STORAGE_URI)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
+if METRICS_ENABLED:
+    for instrumented_engine in (engine, *read_engines):
+        instrument_engine(instrumented_engine)
+    app.add_middleware(MetricsMiddleware)
+
 SessionDep = Annotated[AsyncSession, Depends(get_sessions)]
+PrimarySessionDep = Annotated[AsyncSession, Depends(get_primary_session)]
+PrincipalDep = Annotated[Principal, Depends(get_principal)]
+AdminDep = Annotated[Principal, Depends(get_admin)]
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+MAX_SEARCH_OFFSET = 10000
+FEED_SIZE = int(os.getenv('FEED_SIZE', 500))
+WARM_POSTS = int(os.getenv('WARM_POSTS', 200))
+
+
+USER_COLUMNS = (UserModel.id.label('user_id'), UserModel.username, UserModel.bio, UserModel.age)
+POST_COLUMNS = (PostModel.id.label('post_id'), PostModel.author_id, PostModel.title, PostModel.body,
+                PostModel.like_count.label('likes'))
+LIKE_COLUMNS = (LikeModel.id.label('like_id'), LikeModel.post_id, LikeModel.author_id)
+COMMENT_COLUMNS = (CommentModel.id.label('comment_id'), CommentModel.post_id, CommentModel.title,
+                   CommentModel.author_id)
+
+
+def paginate(query, model, limit: int, after: Optional[int]):
+    if after is not None:
+        query = query.where(model.id > after)
+    return query.order_by(model.id).limit(limit + 1)
+
+
+def split_page(rows: list, limit: int):
+    # the id is always the first selected column
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1][0]
+    return rows, None
+
+
+NDJSON = 'application/x-ndjson'
+STREAM_CHUNK = 1000
+
+
+def wants_ndjson(request: Request) -> bool:
+    return NDJSON in request.headers.get('accept', '')
+
+
+def stream_ndjson(request: Request, query, adapter, transform=None) -> StreamingResponse:
+    async def generate():
+        async with request_session(request) as session:
+            result = await session.stream(query.execution_options(yield_per=STREAM_CHUNK))
+            async for rows in result.partitions():
+                items = adapter.validate_python(rows, from_attributes=True)
+                if transform is not None:
+                    items = [transform(item) for item in items]
+                yield ''.join(item.model_dump_json() + '\n' for item in items)
+
+    return StreamingResponse(generate(), media_type=NDJSON)
+
+
+def cache_response(session: AsyncSession, key, value, tags: tuple = ()):
+    # filled from the primary only, a lagging replica would put back what a write has just evicted
+    if not is_replica(session):
+        response_cache.set(key, value, tags=tags)
+
+
+def make_etag(kind: str, post_id: int, version: int, *params) -> str:
+    return '"' + '-'.join(str(part) for part in (kind, post_id, version, *params)) + '"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get('if-none-match')
+    if not header:
+        return False
+    etags = [value.strip().removeprefix('W/') for value in header.split(',')]
+    return etag in etags or '*' in etags
+
+
+async def get_post_version(session: AsyncSession, post_id: int) -> int:
+    version = response_cache.get(version_key(post_id))
+    if version is MISSING:
+        result = await session.execute(select(PostModel.version).where(PostModel.id == post_id))
+        version = result.scalar()
+        if version is None:
+            raise HTTPException(status_code=404, detail='Post not found')
+        cache_response(session, version_key(post_id), version)
+    return version
+
+
+async def change_post_counters(session: AsyncSession, post_id: int, likes: int = 0, comments: int = 0):
+    query = update(PostModel).where(PostModel.id == post_id).values(
+        like_count=PostModel.like_count + likes,
+        comment_count=PostModel.comment_count + comments,
+        version=PostModel.version + 1
+    )
+    await session.execute(query)
+
+
+async def change_many_post_counters(session: AsyncSession, likes: Counter = None, comments: Counter = None):
+    likes, comments = likes or Counter(), comments or Counter()
+    values = {'version': PostModel.version + 1}
+    if likes:
+        values['like_count'] = PostModel.like_count + case(likes, value=PostModel.id, else_=0)
+    if comments:
+        values['comment_count'] = PostModel.comment_count + case(comments, value=PostModel.id, else_=0)
+    query = update(PostModel).where(PostModel.id.in_(set(likes) | set(comments))).values(**values)
+    await session.execute(query.execution_options(synchronize_session=False))
+
+
+async def existing_post_ids(session: AsyncSession, post_ids) -> set:
+    result = await session.execute(select(PostModel.id).where(PostModel.id.in_(set(post_ids))))
+    return set(result.scalars().all())
+
+
+@like_buffer.flusher
+async def flush_likes(likes: set):
+    async with session_local() as session:
+        # posts and accounts deleted since the like was accepted are skipped
+        posts = await existing_post_ids(session, [post_id for post_id, _ in likes])
+        result = await session.execute(select(UserModel.id).where(UserModel.id.in_({uid for _, uid in likes})))
+        users = set(result.scalars().all())
+        rows = [{'post_id': post_id, 'author_id': uid} for post_id, uid in likes if post_id in posts and uid in users]
+        liked = Counter()
+        if rows:
+            query = insert(LikeModel).values(rows) \
+                .on_conflict_do_nothing(index_elements=[LikeModel.post_id, LikeModel.author_id]) \
+                .returning(LikeModel.post_id)
+            result = await session.execute(query)
+            liked.update(result.scalars().all())
+        if liked:
+            await change_many_post_counters(session, likes=liked)
+        await session.commit()
+    evict_posts(*liked, comments=False)
+
+
+async def buffer_like(session: AsyncSession, post_id: int, uid: int):
+    # a hot post's likes are accepted from memory, the insert and the counter update wait for the next flush
+    await get_post_version(session, post_id)
+    if like_buffer.likers(post_id) is None:
+        result = await session.execute(select(LikeModel.author_id).where(LikeModel.post_id == post_id))
+        like_buffer.load_likers(post_id, result.scalars().all())
+    if not like_buffer.add(post_id, uid):
+        raise HTTPException(status_code=401, detail='Like already given')
+
+
+def with_pending_likes(post: PostResponseSchema) -> PostResponseSchema:
+    pending = like_buffer.pending_likes(post.post_id)
+    return post.model_copy(update={'likes': post.likes + pending}) if pending else post
+
+
+async def recount_post_counters(session: AsyncSession):
+    like_count = select(func.count(LikeModel.id)).where(LikeModel.post_id == PostModel.id).scalar_subquery()
+    comment_count = select(func.count(CommentModel.id)).where(CommentModel.post_id == PostModel.id).scalar_subquery()
+    query = update(PostModel).values(like_count=like_count, comment_count=comment_count, version=PostModel.version + 1)
+    await session.execute(query.execution_options(synchronize_session=False))
+
+
+async def warm_up() -> dict:
+    pool = await warm_pool()
+    async with session_local() as session:
+        # the newest posts are the likeliest to be read first, they go into the response cache
+        query = select(*POST_COLUMNS, PostModel.version).order_by(PostModel.id.desc()).limit(WARM_POSTS)
+        result = await session.execute(query)
+        posts = result.all()
+        for post in posts:
+            response_cache.set(post_key(post.post_id), PostResponseSchema.model_validate(post, from_attributes=True))
+            response_cache.set(version_key(post.post_id), post.version)
+
+    # running the hot read statements once puts them into every engine's compiled statement cache
+    for make_session in (session_local, *read_session_makers):
+        async with make_session() as session:
+            for query in (
+                paginate(select(*USER_COLUMNS), UserModel, PAGE_SIZE, None),
+                paginate(select(*POST_COLUMNS), PostModel, PAGE_SIZE, None),
+                select(*POST_COLUMNS).where(PostModel.id == 0),
+                select(PostModel.version).where(PostModel.id == 0),
+                select(UserModel.id, UserModel.role).where(UserModel.id == 0),
+                paginate(select(*LIKE_COLUMNS).where(LikeModel.post_id == 0), LikeModel, PAGE_SIZE, None),
+                paginate(select(*COMMENT_COLUMNS).where(CommentModel.post_id == 0), CommentModel, PAGE_SIZE, None),
+                feed_query(0, PAGE_SIZE, None),
+            ):
+                await session.execute(query)
+    return {'connections': pool, 'posts': len(posts)}
+
+
+# There is no follow graph yet, so a post goes to its author and to everyone who has liked or
+# commented on the author's posts
+def feed_audience(author_id: int):
+    likers = select(LikeModel.author_id).join(PostModel, PostModel.id == LikeModel.post_id) \
+        .where(PostModel.author_id == author_id)
+    commenters = select(CommentModel.author_id).join(PostModel, PostModel.id == CommentModel.post_id) \
+        .where(PostModel.author_id == author_id)
+    return select(literal(author_id).label('user_id')).union(likers, commenters).subquery()
+
+
+async def fan_out_post(session: AsyncSession, post_id: int, author_id: int):
+    audience = feed_audience(author_id)
+    # every fan-out adds at most one entry per timeline, so dropping the one past FEED_SIZE keeps them bounded
+    timeline = aliased(FeedEntryModel)
+    overflow = select(timeline.id).where(timeline.user_id == audience.c.user_id) \
+        .order_by(timeline.post_id.desc()).offset(FEED_SIZE).limit(1).correlate(audience).scalar_subquery()
+    for query in (
+        insert(FeedEntryModel).from_select(['user_id', 'post_id'], select(audience.c.user_id, literal(post_id))),
+        delete(FeedEntryModel).where(FeedEntryModel.id.in_(select(overflow).select_from(audience))),
+    ):
+        await session.execute(query.execution_options(synchronize_session=False))
+
+
+def feed_query(user_id: int, limit: int, before: Optional[int]):
+    query = select(*POST_COLUMNS).join(FeedEntryModel, FeedEntryModel.post_id == PostModel.id) \
+        .where(FeedEntryModel.user_id == user_id)
+    if before is not None:
+        query = query.where(FeedEntryModel.post_id < before)
+    return query.order_by(FeedEntryModel.post_id.desc()).limit(limit + 1)
+
+
+async def delete_posts_cascade(session: AsyncSession, post_ids: list):
+    await unindex_posts(session, post_ids)
+    for query in (
+        delete(FeedEntryModel).where(FeedEntryModel.post_id.in_(post_ids)),
+        delete(LikeModel).where(LikeModel.post_id.in_(post_ids)),
+        delete(CommentModel).where(CommentModel.post_id.in_(post_ids)),
+        delete(PostModel).where(PostModel.id.in_(post_ids)),
+    ):
+        await session.execute(query.execution_options(synchronize_session=False))
+
+
+async def delete_in_chunks(job: Job, query, process):
+    # every chunk is its own short transaction, so other writers get the database in between
+    while True:
+        async with session_local() as session:
+            result = await session.execute(query.limit(JOB_CHUNK_SIZE))
+            rows = result.all()
+            if not rows:
+                return
+            affected_posts = await process(session, rows)
+            await job.advance(session, len(rows))
+            await session.commit()
+        evict_posts(*affected_posts)
+        forget_likers(*affected_posts)
+
+
+# The account row is deleted by the request, the job removes everything the user left behind.
+# Likes and comments go first, so the counters of other users' posts stay right throughout.
+@job_queue.handler('delete_user')
+async def delete_user_job(job: Job):
+    user_id = job.params['user_id']
+    user_posts = select(PostModel.id).where(PostModel.author_id == user_id)
+
+    # the deltas come from the rows this chunk actually deleted, a rerun of the job can't count a row twice
+    async def delete_likes(session: AsyncSession, rows: list) -> list:
+        query = delete(LikeModel).where(LikeModel.id.in_([like_id for like_id, _ in rows])) \
+            .returning(LikeModel.post_id)
+        result = await session.execute(query.execution_options(synchronize_session=False))
+        likes = Counter()
+        for post_id in result.scalars().all():
+            likes[post_id] -= 1
+        await change_many_post_counters(session, likes=likes)
+        return list(likes)
+
+    async def delete_comments(session: AsyncSession, rows: list) -> list:
+        comment_ids = [comment_id for comment_id, _ in rows]
+        await unindex_comments(session, comment_ids)
+        query = delete(CommentModel).where(CommentModel.id.in_(comment_ids)).returning(CommentModel.post_id)
+        result = await session.execute(query.execution_options(synchronize_session=False))
+        comments = Counter()
+        for post_id in result.scalars().all():
+            comments[post_id] -= 1
+        await change_many_post_counters(session, comments=comments)
+        return list(comments)
+
+    async def delete_posts(session: AsyncSession, rows: list) -> list:
+        post_ids = [post_id for post_id, in rows]
+        await delete_posts_cascade(session, post_ids)
+        return post_ids
+
+    async def delete_feed(session: AsyncSession, rows: list) -> list:
+        query = delete(FeedEntryModel).where(FeedEntryModel.id.in_([entry_id for entry_id, in rows]))
+        await session.execute(query.execution_options(synchronize_session=False))
+        return []
+
+    await delete_in_chunks(job, select(LikeModel.id, LikeModel.post_id).where(
+        or_(LikeModel.author_id == user_id, LikeModel.post_id.in_(user_posts))
+    ), delete_likes)
+    await delete_in_chunks(job, select(CommentModel.id, CommentModel.post_id).where(
+        or_(CommentModel.author_id == user_id, CommentModel.post_id.in_(user_posts))
+    ), delete_comments)
+    await delete_in_chunks(job, user_posts, delete_posts)
+    await delete_in_chunks(job, select(FeedEntryModel.id).where(FeedEntryModel.user_id == user_id), delete_feed)
+
+
+async def last_post_id(conn) -> int:
+    # the highest id ever handed out, deleted posts included
+    if engine.dialect.name == 'postgresql':
+        result = await conn.execute(text("SELECT last_value FROM posts_id_seq WHERE is_called"))
+    else:
+        result = await conn.execute(text("SELECT seq FROM sqlite_sequence WHERE name = 'posts'"))
+    return result.scalar() or 0
+
+
+async def restore_last_post_id(conn, post_id: int):
+    if not post_id:
+        return
+    if engine.dialect.name == 'postgresql':
+        await conn.execute(text("SELECT setval('posts_id_seq', :post_id)"), {'post_id': post_id})
+    else:
+        await conn.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES ('posts', :post_id)"),
+                           {'post_id': post_id})
+
+
+@job_queue.handler('setup_database')
+async def setup_database_job(job: Job):  # noqa
+    # the jobs table survives, it holds this very job
+    tables = [table for table in Base.metadata.sorted_tables if table is not JobModel.__table__]
+    async with engine.begin() as conn:
+        post_id = await last_post_id(conn)
+        await conn.run_sync(Base.metadata.drop_all, tables=tables)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all, tables=tables)
+        # dropping the table forgets its sequence, new posts must not get the ids (and ETags) of old ones
+        await restore_last_post_id(conn, post_id)
+    clear_caches()
+
+
+async def delete_account(session: AsyncSession, user_id: int, owner_id: int) -> int:
+    result = await session.execute(delete(UserModel).where(UserModel.id == user_id))
+    if not result.rowcount:
+        raise HTTPException(status_code=404, detail='User not found')
+    job_id = await job_queue.enqueue(session, 'delete_user', owner_id=owner_id, user_id=user_id)
+    token_cache.invalidate_user(user_id)
+    evict_user(user_id)
+    return job_id
 
 
 @app.post('/register', tags=['Пользователь 😀'])
@@ -36,19 +406,17 @@ async def register(
         creds: UserRegisterSchema,
         request: Request,  # noqa
         session: SessionDep) -> dict:
-    query = select(UserModel).where(creds.username == UserModel.username)
-    result = await session.execute(query)
-    if result.scalar():
-        raise HTTPException(status_code=401, detail='Users exists')
-    password_hash = hashlib.md5(creds.password.encode()).hexdigest()
-    new_user = UserModel(
+    password_hash = await hash_password(creds.password)
+    query = insert(UserModel).values(
         username=creds.username,
         password=password_hash,
         bio=creds.bio,
         age=creds.age,
         role='user'
-    )
-    session.add(new_user)
+    ).on_conflict_do_nothing(index_elements=[UserModel.username])
+    result = await session.execute(query)
+    if not result.rowcount:
+        raise HTTPException(status_code=401, detail='Users exists')
     await session.commit()
     return {'ok': True}
 
@@ -65,385 +433,455 @@ async def login(
     if not db_user:
         raise HTTPException(status_code=401, detail='Incorrect username')
 
-    password_hash = hashlib.md5(creds.password.encode()).hexdigest()
-    if db_user.password == password_hash:
+    uid, role, password_hash = db_user.id, db_user.role, db_user.password
+    # give the pooled connection back while the hash runs in the executor
+    await session.rollback()
+
+    password_ok, needs_rehash = await verify_password(creds.password, password_hash)
+    if password_ok:
+        if needs_rehash:
+            password_hash = await hash_password(creds.password)
+            query = update(UserModel).where(UserModel.id == uid).values(password=password_hash)
+            await session.execute(query)
+            await session.commit()
         token = auth.create_access_token(
-            uid=str(db_user.id),
+            uid=str(uid),
             data={
-                "role": db_user.role,
+                "role": role,
             }
         )
         get_payload_from_token(token)
+        # the token's first requests may come right after registration, before a replica has the user
+        stick_to_primary(uid)
         return {'access_token': token}
     raise HTTPException(status_code=401, detail='Incorrect password')
 
 
-@app.get('/users', dependencies=[Depends(auth.get_token_from_request)], tags=['Пользователь 😀'])
+@app.get('/users', tags=['Пользователь 😀'])
 @limiter.limit("5/15 seconds")
 async def get_users(
         session: SessionDep,
+        principal: PrincipalDep,
         request: Request,  # noqa
-        token: RequestToken = Depends()) -> List[UserResponseSchema]:
-    await verify_token(token, session)
-
-    query = select(UserModel)
+        limit: int = Query(default=PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        after: Optional[int] = None) -> UserPageSchema:
+    if wants_ndjson(request):
+        query = select(*USER_COLUMNS).order_by(UserModel.id)
+        if after is not None:
+            query = query.where(UserModel.id > after)
+        return stream_ndjson(request, query, user_list_adapter)
+
+    query = paginate(select(*USER_COLUMNS), UserModel, limit, after)
     results = await session.execute(query)
-    new_results = []
-    for result in results.scalars().all():
-        new_results.append(
-            UserResponseSchema(user_id=result.id, username=result.username, bio=result.bio, age=result.age)
-        )
-    return new_results
+    page, next_cursor = split_page(results.all(), limit)
+    items = user_list_adapter.validate_python(page, from_attributes=True)
+    return UserPageSchema(items=items, next_cursor=next_cursor)
 
 
-@app.get('/users/{user_id}', dependencies=[Depends(auth.get_token_from_request)], tags=['Пользователь 😀'])
+@app.get('/users/{user_id}', tags=['Пользователь 😀'])
 @limiter.limit("5/15 seconds")
 async def get_user_with_id(
         user_id: int,
         session: SessionDep,
         request: Request,  # noqa
-        token: RequestToken = Depends()) -> UserResponseSchema:
-    await verify_token(token, session)
+        principal: PrincipalDep) -> UserResponseSchema:
+    cached = response_cache.get(user_key(user_id))
+    if cached is not MISSING:
+        return cached
 
-    query = select(UserModel).where(user_id == UserModel.id)
+    query = select(*USER_COLUMNS).where(user_id == UserModel.id)
     db_user = await session.execute(query)
-    db_user = db_user.scalar()
+    db_user = db_user.first()
     if db_user:
-        return UserResponseSchema(user_id=db_user.id, username=db_user.username, bio=db_user.bio, age=db_user.age)
+        user = UserResponseSchema.model_validate(db_user, from_attributes=True)
+        cache_response(session, user_key(user_id), user)
+        return user
     raise HTTPException(status_code=404, detail='User not found')
 
 
-@app.delete('/users', dependencies=[Depends(auth.get_token_from_request)], tags=['Пользователь 😀'])
+@app.delete('/users', status_code=202, tags=['Пользователь 😀'])
 @limiter.limit("5/30 seconds")
 async def delete_user(
         session: SessionDep,
         request: Request,  # noqa
-        token: RequestToken = Depends()) -> dict:
-    await verify_token(token, session)
-
-    uid = get_payload_from_token(token.token)['sub']
-    query = select(UserModel).where(UserModel.id == uid)
-    result = await session.execute(query)
-    user = result.scalar()
-    if not user:
-        raise HTTPException(status_code=404, detail='User not found')
+        principal: PrincipalDep) -> dict:
+    uid = principal.user_id
+    job_id = await delete_account(session, uid, owner_id=uid)
+    # the account is gone, so the job token is the only way to follow the deletion
+    return {'ok': True, 'job_id': job_id, 'job_token': create_job_token(job_id)}
 
-    await session.delete(user)
 
-    query = select(PostModel).where(PostModel.author_id == uid)
-    result = await session.execute(query)
-    for post in result.scalars().all():
-        await session.delete(post)
-
-    query = select(LikeModel).where(LikeModel.author_id == uid)
-    result = await session.execute(query)
-    for like in result.scalars().all():
-        await session.delete(like)
-
-    query = select(CommentModel).where(CommentModel.author_id == uid)
-    result = await session.execute(query)
-    for comment in result.scalars().all():
-        await session.delete(comment)
-
-    await session.commit()
-    return {'ok': True}
-
-
-@app.post('/posts', dependencies=[Depends(auth.get_token_from_request)], tags=['Пост ✉️'])
+@app.post('/posts', tags=['Пост ✉️'])
 @limiter.limit("5/minute")
 async def create_post(
         post: PostCreateSchema,
         session: SessionDep,
         request: Request,  # noqa
-        token: RequestToken = Depends()) -> dict:
-    await verify_token(token, session)
-
-    uid = get_payload_from_token(token.token)['sub']
-
-    query = select(UserModel).where(int(uid) == UserModel.id)
-    result = await session.execute(query)
-    db_user = result.scalar()
-    if not db_user:
-        raise HTTPException(status_code=404, detail='User not found')
-
+        principal: PrincipalDep) -> dict:
+    uid = principal.user_id
     db_post = PostModel(author_id=uid, title=post.title, body=post.body)
     session.add(db_post)
+    await session.flush()
+    await index_post(session, db_post.id, db_post.title, db_post.body)
+    await fan_out_post(session, db_post.id, uid)
     await session.commit()
     return {'ok': True}
 
 
-@app.get('/posts', dependencies=[Depends(auth.get_token_from_request)], tags=['Пост ✉️'])
+@app.get('/posts', tags=['Пост ✉️'])
 @limiter.limit("5/15 seconds")
 async def get_posts(
         session: SessionDep,
+        principal: PrincipalDep,
         request: Request,  # noqa
-        token: RequestToken = Depends()) -> List[PostResponseSchema]:
-    await verify_token(token, session)
-
-    query = select(PostModel)
+        limit: int = Query(default=PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        after: Optional[int] = None) -> PostPageSchema:
+    if wants_ndjson(request):
+        query = select(*POST_COLUMNS).order_by(PostModel.id)
+        if after is not None:
+            query = query.where(PostModel.id > after)
+        return stream_ndjson(request, query, post_list_adapter, with_pending_likes)
+
+    query = paginate(select(*POST_COLUMNS), PostModel, limit, after)
     post_results = await session.execute(query)
-    new_results = []
-    for post_result in post_results.scalars().all():
-        query = select(LikeModel).where(post_result.id == LikeModel.post_id)
-        like_results = await session.execute(query)
-        likes = len(like_results.fetchall())
-
-        new_results.append(
-            PostResponseSchema(
-                post_id=post_result.id,
-                author_id=post_result.author_id,
-                title=post_result.title,
-                body=post_result.body,
-                likes=likes)
-        )
-    return new_results
+    page, next_cursor = split_page(post_results.all(), limit)
+    items = post_list_adapter.validate_python(page, from_attributes=True)
+    return PostPageSchema(items=[with_pending_likes(item) for item in items], next_cursor=next_cursor)
 
 
-@app.get('/posts/{post_id}', dependencies=[Depends(auth.get_token_from_request)], tags=['Пост ✉️'])
+@app.get('/feed', tags=['Пост ✉️'])
 @limiter.limit("5/15 seconds")
-async def get_post_with_id(
-        post_id: int,
+async def get_feed(
         session: SessionDep,
+        principal: PrincipalDep,
         request: Request,  # noqa
-        token: RequestToken = Depends()) -> PostResponseSchema:
-    await verify_token(token, session)
+        limit: int = Query(default=PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        before: Optional[int] = None) -> PostPageSchema:
+    query = feed_query(principal.user_id, limit, before)
+    result = await session.execute(query)
+    page, next_cursor = split_page(result.all(), limit)
+    items = post_list_adapter.validate_python(page, from_attributes=True)
+    return PostPageSchema(items=[with_pending_likes(item) for item in items], next_cursor=next_cursor)
+
 
-    query = select(PostModel).where(post_id == PostModel.id)
+@app.get('/search', tags=['Пост ✉️'])
+@limiter.limit("5/15 seconds")
+async def search(
+        q: str,
+        session: SessionDep,
+        principal: PrincipalDep,
+        request: Request,  # noqa
+        limit: int = Query(default=PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        offset: int = Query(default=0, ge=0, le=MAX_SEARCH_OFFSET)) -> SearchPageSchema:
+    if not SEARCH_ENABLED:
+        raise HTTPException(status_code=501, detail='Search needs SQLite FTS5')
+    match = match_expression(q)
+    if match is None:
+        return SearchPageSchema(items=[], next_cursor=None)
+
+    # ranked results can't be keyset paginated, next_cursor is the offset of the next page
+    result = await session.execute(search_query(match, limit, offset))
+    rows = result.all()
+    next_cursor = offset + limit if len(rows) > limit else None
+    items = search_list_adapter.validate_python(rows[:limit], from_attributes=True)
+    return SearchPageSchema(items=items, next_cursor=next_cursor)
+
+
+@app.get('/posts/{post_id}', tags=['Пост ✉️'])
+@limiter.limit("5/15 seconds")
+async def get_post_with_id(
+        post_id: int,
+        session: SessionDep,
+        principal: PrincipalDep,
+        request: Request,
+        response: Response) -> PostResponseSchema:
+    # likes still in the write-behind buffer change the body before they change the version
+    pending = like_buffer.pending_likes(post_id)
+    etag = make_etag('post', post_id, await get_post_version(session, post_id), *([f'p{pending}'] if pending else []))
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={'ETag': etag})
+    response.headers['ETag'] = etag
+
+    cached = response_cache.get(post_key(post_id))
+    if cached is not MISSING:
+        return with_pending_likes(cached)
+
+    query = select(*POST_COLUMNS).where(post_id == PostModel.id)
     result = await session.execute(query)
-    post = result.scalar()
+    post = result.first()
     if not post:
         raise HTTPException(status_code=404, detail='Post not found')
 
-    query = select(LikeModel).where(post_id == LikeModel.post_id)
-    like_results = await session.execute(query)
-    likes = len(like_results.fetchall())
-
-    return PostResponseSchema(
-        post_id=post.id,
-        author_id=post.author_id,
-        title=post.title,
-        body=post.body,
-        likes=likes
-    )
+    post = PostResponseSchema.model_validate(post, from_attributes=True)
+    cache_response(session, post_key(post_id), post)
+    return with_pending_likes(post)
 
 
-@app.delete('/posts', dependencies=[Depends(auth.get_token_from_request)], tags=['Пост ✉️'])
+@app.delete('/posts', tags=['Пост ✉️'])
 @limiter.limit("5/30 seconds")
 async def delete_post(
         post_id: int,
         session: SessionDep,
         request: Request,  # noqa
-        token: RequestToken = Depends()) -> dict:
-    await verify_token(token, session)
-
+        principal: PrincipalDep) -> dict:
     query = select(PostModel).where(PostModel.id == post_id)
     result = await session.execute(query)
     post = result.scalar()
     if not post:
         raise HTTPException(status_code=404, detail='Post not found')
 
-    uid = get_payload_from_token(token.token)['sub']
-    if post.author_id != int(uid):
+    uid = principal.user_id
+    if post.author_id != uid:
         raise HTTPException(status_code=401, detail='This post is not yours')
 
-    await session.delete(post)
-
-    query = select(LikeModel).where(LikeModel.post_id == post_id)
-    result = await session.execute(query)
-    for like in result.scalars().all():
-        await session.delete(like)
-
-    query = select(CommentModel).where(CommentModel.post_id == post_id)
-    result = await session.execute(query)
-    for comment in result.scalars().all():
-        await session.delete(comment)
-
+    await delete_posts_cascade(session, [post_id])
     await session.commit()
+    evict_posts(post_id)
+    forget_likers(post_id)
     return {'ok': True}
 
 
-@app.post('/likes', dependencies=[Depends(auth.get_token_from_request)], tags=['Лайк 💘'])
+@app.post('/likes', tags=['Лайк 💘'])
 @limiter.limit("5/30 seconds")
 async def put_like(
         post_id: int,
         session: SessionDep,
         request: Request,  # noqa
-        token: RequestToken = Depends()) -> dict:
-    await verify_token(token, session)
-
-    uid = get_payload_from_token(token.token)['sub']
-
-    query = select(PostModel).where(PostModel.id == post_id)
-    result = await session.execute(query)
-    if not result.scalar():
-        raise HTTPException(status_code=404, detail='Post not found')
+        principal: PrincipalDep) -> dict:
+    uid = principal.user_id
+    if like_buffer.enabled:
+        await buffer_like(session, post_id, uid)
+        return {'ok': True}
 
-    query = select(LikeModel).where(LikeModel.author_id == uid).where(LikeModel.post_id == post_id)
+    post_exists = select(PostModel.id).where(PostModel.id == post_id).exists()
+    query = insert(LikeModel).from_select(
+        [LikeModel.post_id, LikeModel.author_id],
+        select(literal(post_id), literal(uid)).where(post_exists)
+    ).on_conflict_do_nothing(index_elements=[LikeModel.post_id, LikeModel.author_id])
     result = await session.execute(query)
-    if result.scalar():
+    if not result.rowcount:
+        query = select(PostModel.id).where(PostModel.id == post_id)
+        result = await session.execute(query)
+        if not result.scalar():
+            raise HTTPException(status_code=404, detail='Post not found')
         raise HTTPException(status_code=401, detail='Like already given')
 
-    like = LikeModel(post_id=post_id, author_id=uid)
-    session.add(like)
+    await change_post_counters(session, post_id, likes=1)
     await session.commit()
+    evict_posts(post_id, comments=False)
     return {'ok': True}
 
 
-@app.get('/likes', dependencies=[Depends(auth.get_token_from_request)], tags=['Лайк 💘'])
+@app.post('/likes/batch', tags=['Лайк 💘'])
+@limiter.limit("5/30 seconds")
+async def put_likes_batch(
+        batch: LikeBatchSchema,
+        session: SessionDep,
+        request: Request,  # noqa
+        principal: PrincipalDep) -> List[BatchItemResultSchema]:
+    uid = principal.user_id
+    posts = await existing_post_ids(session, batch.post_ids)
+    liked = set()
+    if posts:
+        query = insert(LikeModel).values([{'post_id': post_id, 'author_id': uid} for post_id in posts]) \
+            .on_conflict_do_nothing(index_elements=[LikeModel.post_id, LikeModel.author_id]) \
+            .returning(LikeModel.post_id)
+        result = await session.execute(query)
+        liked = set(result.scalars().all())
+    if liked:
+        await change_many_post_counters(session, likes=Counter(liked))
+    await session.commit()
+    evict_posts(*liked, comments=False)
+    like_buffer.add_likers(liked, uid)
+
+    results = []
+    for post_id in batch.post_ids:
+        if post_id not in posts:
+            results.append(BatchItemResultSchema(post_id=post_id, ok=False, detail='Post not found'))
+        elif post_id in liked:
+            liked.discard(post_id)
+            results.append(BatchItemResultSchema(post_id=post_id, ok=True))
+        else:
+            results.append(BatchItemResultSchema(post_id=post_id, ok=False, detail='Like already given'))
+    return results
+
+
+@app.get('/likes', tags=['Лайк 💘'])
 @limiter.limit("5/15 seconds")
 async def get_likes(
         post_id: int,
         session: SessionDep,
-        request: Request,  # noqa
-        token: RequestToken = Depends()) -> List[LikeResponseSchema]:
-    await verify_token(token, session)
-
-    query = select(PostModel).where(PostModel.id == post_id)
-    result = await session.execute(query)
-    if not result.scalar():
-        raise HTTPException(status_code=404, detail='Post not found')
-
-    query = select(LikeModel).where(LikeModel.post_id == post_id)
+        principal: PrincipalDep,
+        request: Request,
+        response: Response,
+        limit: int = Query(default=PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        after: Optional[int] = None) -> LikePageSchema:
+    etag = make_etag('likes', post_id, await get_post_version(session, post_id), after, limit)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={'ETag': etag})
+    response.headers['ETag'] = etag
+
+    cached = response_cache.get(likes_key(post_id, after, limit))
+    if cached is not MISSING:
+        return cached
+
+    query = paginate(select(*LIKE_COLUMNS).where(LikeModel.post_id == post_id), LikeModel, limit, after)
     results = await session.execute(query)
-    new_results = []
-    for result in results.scalars().all():
-        new_results.append(
-            LikeResponseSchema(like_id=result.id, post_id=post_id, author_id=result.author_id)
-        )
-    return new_results
+    page, next_cursor = split_page(results.all(), limit)
+    items = like_list_adapter.validate_python(page, from_attributes=True)
+    likes = LikePageSchema(items=items, next_cursor=next_cursor)
+    cache_response(session, likes_key(post_id, after, limit), likes, tags=(likes_tag(post_id),))
+    return likes
 
 
-@app.delete('/likes', dependencies=[Depends(auth.get_token_from_request)], tags=['Лайк 💘'])
+@app.delete('/likes', tags=['Лайк 💘'])
 @limiter.limit("5/30 seconds")
 async def delete_like(
         like_id: int,
         session: SessionDep,
         request: Request,  # noqa
-        token: RequestToken = Depends()) -> dict:
-    await verify_token(token, session)
-
+        principal: PrincipalDep) -> dict:
     query = select(LikeModel).where(LikeModel.id == like_id)
     result = await session.execute(query)
     comment = result.scalar()
     if not comment:
         raise HTTPException(status_code=404, detail='Like not found')
 
-    uid = get_payload_from_token(token.token)['sub']
-    if comment.author_id != int(uid):
+    uid = principal.user_id
+    if comment.author_id != uid:
         raise HTTPException(status_code=401, detail='This like is not yours')
 
     await session.delete(comment)
+    await change_post_counters(session, comment.post_id, likes=-1)
     await session.commit()
+    evict_posts(comment.post_id, comments=False)
+    forget_likers(comment.post_id)
     return {'ok': True}
 
 
-@app.post('/comments', dependencies=[Depends(auth.get_token_from_request)], tags=['Комментарий ✒️'])
+@app.post('/comments', tags=['Комментарий ✒️'])
 @limiter.limit("5/30 seconds")
 async def add_comment(
         comment: CommentSchema,
         session: SessionDep,
         request: Request,  # noqa
-        token: RequestToken = Depends()) -> dict:
-    await verify_token(token, session)
-
+        principal: PrincipalDep) -> dict:
     query = select(PostModel).where(PostModel.id == comment.post_id)
     result = await session.execute(query)
     if not result.scalar():
         raise HTTPException(status_code=404, detail='Post not found')
 
-    uid = get_payload_from_token(token.token)['sub']
+    uid = principal.user_id
 
     db_comment = CommentModel(post_id=comment.post_id, author_id=uid, title=comment.title)
     session.add(db_comment)
+    await session.flush()
+    await index_comments(session, [(db_comment.id, db_comment.post_id, db_comment.title)])
+    await change_post_counters(session, comment.post_id, comments=1)
     await session.commit()
+    evict_posts(comment.post_id, likes=False)
     return {'ok': True}
 
 
-@app.get('/comments', dependencies=[Depends(auth.get_token_from_request)], tags=['Комментарий ✒️'])
-@limiter.limit("5/15 seconds")
-async def get_comments(
-        post_id: int,
+@app.post('/comments/batch', tags=['Комментарий ✒️'])
+@limiter.limit("5/30 seconds")
+async def add_comments_batch(
+        batch: CommentBatchSchema,
         session: SessionDep,
         request: Request,  # noqa
-        token: RequestToken = Depends()) -> List[CommentResponseSchema]:
-    await verify_token(token, session)
+        principal: PrincipalDep) -> List[BatchItemResultSchema]:
+    uid = principal.user_id
+    posts = await existing_post_ids(session, [comment.post_id for comment in batch.comments])
+    rows = [
+        {'post_id': comment.post_id, 'author_id': uid, 'title': comment.title}
+        for comment in batch.comments if comment.post_id in posts
+    ]
+    if rows:
+        query = insert(CommentModel).values(rows).returning(CommentModel.id, CommentModel.post_id, CommentModel.title)
+        result = await session.execute(query)
+        await index_comments(session, result.all())
+        await change_many_post_counters(session, comments=Counter(row['post_id'] for row in rows))
+    await session.commit()
+    evict_posts(*posts, likes=False)
+
+    return [
+        BatchItemResultSchema(post_id=comment.post_id, ok=True) if comment.post_id in posts
+        else BatchItemResultSchema(post_id=comment.post_id, ok=False, detail='Post not found')
+        for comment in batch.comments
+    ]
 
-    query = select(PostModel).where(PostModel.id == post_id)
-    result = await session.execute(query)
-    if not result.scalar():
-        raise HTTPException(status_code=404, detail='Post not found')
 
-    query = select(CommentModel).where(CommentModel.post_id == post_id)
+@app.get('/comments', tags=['Комментарий ✒️'])
+@limiter.limit("5/15 seconds")
+async def get_comments(
+        post_id: int,
+        session: SessionDep,
+        principal: PrincipalDep,
+        request: Request,
+        response: Response,
+        limit: int = Query(default=PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        after: Optional[int] = None) -> CommentPageSchema:
+    etag = make_etag('comments', post_id, await get_post_version(session, post_id), after, limit)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={'ETag': etag})
+    response.headers['ETag'] = etag
+
+    cached = response_cache.get(comments_key(post_id, after, limit))
+    if cached is not MISSING:
+        return cached
+
+    query = paginate(select(*COMMENT_COLUMNS).where(CommentModel.post_id == post_id), CommentModel, limit, after)
     results = await session.execute(query)
-    new_results = []
-    for result in results.scalars().all():
-        new_results.append(
-            CommentResponseSchema(comment_id=result.id, post_id=post_id, title=result.title, author_id=result.author_id)
-        )
-    return new_results
+    page, next_cursor = split_page(results.all(), limit)
+    items = comment_list_adapter.validate_python(page, from_attributes=True)
+    comments = CommentPageSchema(items=items, next_cursor=next_cursor)
+    cache_response(session, comments_key(post_id, after, limit), comments, tags=(comments_tag(post_id),))
+    return comments
 
 
-@app.delete('/comments', dependencies=[Depends(auth.get_token_from_request)], tags=['Комментарий ✒️'])
+@app.delete('/comments', tags=['Комментарий ✒️'])
 @limiter.limit("5/30 seconds")
 async def delete_comment(
         comment_id: int,
         session: SessionDep,
         request: Request,  # noqa
-        token: RequestToken = Depends()) -> dict:
-    await verify_token(token, session)
-
+        principal: PrincipalDep) -> dict:
     query = select(CommentModel).where(CommentModel.id == comment_id)
     result = await session.execute(query)
     comment = result.scalar()
     if not comment:
         raise HTTPException(status_code=404, detail='Comment not found')
 
-    uid = get_payload_from_token(token.token)['sub']
-    if comment.author_id != int(uid):
+    uid = principal.user_id
+    if comment.author_id != uid:
         raise HTTPException(status_code=401, detail='This comment is not yours')
 
     await session.delete(comment)
+    await unindex_comments(session, [comment.id])
+    await change_post_counters(session, comment.post_id, comments=-1)
     await session.commit()
+    evict_posts(comment.post_id, likes=False)
     return {'ok': True}
 
 
-@app.post('/admin/drop_and_create_database', dependencies=[Depends(auth.get_token_from_request)], tags=['Админ ✨'])
+@app.post('/admin/drop_and_create_database', status_code=202, tags=['Админ ✨'])
 @limiter.limit("5/minute")
 async def admin_setup_database(
-        request: Request,  # noqa
         session: SessionDep,
-        token: RequestToken = Depends()) -> dict:
-    if not os.path.exists('database.db'):
-        async with engine.begin() as conn:
-            await conn.run_sync(Base.metadata.drop_all)
-            await conn.run_sync(Base.metadata.create_all)
-        return {'ok': True}
-    uid = get_payload_from_token(token.token)['sub']
-    query = select(UserModel).where(UserModel.id == uid)
-    result = await session.execute(query)
-    if result.scalar().role != 'admin':
-        raise HTTPException(status_code=403, detail='You are not admin')
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.drop_all)
-        await conn.run_sync(Base.metadata.create_all)
-    return {'ok': True}
+        request: Request,  # noqa
+        admin: AdminDep) -> dict:
+    job_id = await job_queue.enqueue(session, 'setup_database', owner_id=admin.user_id)
+    # the reset drops the admin's account too, the job token still lets them follow it
+    return {'ok': True, 'job_id': job_id, 'job_token': create_job_token(job_id)}
 
 
-@app.delete('/admin/delete_comment', dependencies=[Depends(auth.get_token_from_request)], tags=['Админ ✨'])
+@app.delete('/admin/delete_comment', tags=['Админ ✨'])
 @limiter.limit("5/30 seconds")
 async def admin_delete_comment(
         comment_id: int,
         session: SessionDep,
         request: Request,  # noqa
-        token: RequestToken = Depends()) -> dict:
-    await verify_token(token, session)
-
-    uid = get_payload_from_token(token.token)['sub']
-    query = select(UserModel).where(UserModel.id == uid)
-    result = await session.execute(query)
-    if result.scalar().role != 'admin':
-        raise HTTPException(status_code=403, detail='You are not admin')
-
+        admin: AdminDep) -> dict:
     query = select(CommentModel).where(CommentModel.id == comment_id)
     result = await session.execute(query)
     comment = result.scalar()
@@ -451,25 +889,20 @@ async def admin_delete_comment(
         raise HTTPException(status_code=404, detail='Comment not found')
 
     await session.delete(comment)
+    await unindex_comments(session, [comment.id])
+    await change_post_counters(session, comment.post_id, comments=-1)
     await session.commit()
+    evict_posts(comment.post_id, likes=False)
     return {'ok': True}
 
 
-@app.delete('/admin/delete_like', dependencies=[Depends(auth.get_token_from_request)], tags=['Админ ✨'])
+@app.delete('/admin/delete_like', tags=['Админ ✨'])
 @limiter.limit("5/30 seconds")
 async def admin_delete_like(
         like_id: int,
         session: SessionDep,
         request: Request,  # noqa
-        token: RequestToken = Depends()) -> dict:
-    await verify_token(token, session)
-
-    uid = get_payload_from_token(token.token)['sub']
-    query = select(UserModel).where(UserModel.id == uid)
-    result = await session.execute(query)
-    if result.scalar().role != 'admin':
-        raise HTTPException(status_code=403, detail='You are not admin')
-
+        admin: AdminDep) -> dict:
     query = select(LikeModel).where(LikeModel.id == like_id)
     result = await session.execute(query)
     comment = result.scalar()
@@ -477,45 +910,88 @@ async def admin_delete_like(
         raise HTTPException(status_code=404, detail='Like not found')
 
     await session.delete(comment)
+    await change_post_counters(session, comment.post_id, likes=-1)
     await session.commit()
+    evict_posts(comment.post_id, comments=False)
+    forget_likers(comment.post_id)
     return {'ok': True}
 
 
-@app.delete('/admin/delete_user', dependencies=[Depends(auth.get_token_from_request)], tags=['Админ ✨'])
-@limiter.limit("5/30 seconds")
-async def delete_user(
-        user_id: int,
+@app.post('/admin/recount_posts', tags=['Админ ✨'])
+@limiter.limit("5/minute")
+async def admin_recount_posts(
         session: SessionDep,
         request: Request,  # noqa
-        token: RequestToken = Depends()) -> dict:
-    await verify_token(token, session)
+        admin: AdminDep) -> dict:
+    await recount_post_counters(session)
+    await session.commit()
+    clear_responses()
+    return {'ok': True}
 
-    query = select(UserModel).where(UserModel.id == user_id)
-    result = await session.execute(query)
-    user = result.scalar()
-    if not user:
-        raise HTTPException(status_code=404, detail='User not found')
 
-    await session.delete(user)
+@app.post('/admin/rebuild_search', tags=['Админ ✨'])
+@limiter.limit("5/minute")
+async def admin_rebuild_search(
+        session: SessionDep,
+        request: Request,  # noqa
+        admin: AdminDep) -> dict:
+    if not SEARCH_ENABLED:
+        raise HTTPException(status_code=501, detail='Search needs SQLite FTS5')
+    await rebuild_search_index(session)
+    await session.commit()
+    return {'ok': True}
 
-    query = select(PostModel).where(PostModel.author_id == user_id)
-    result = await session.execute(query)
-    for post in result.scalars().all():
-        await session.delete(post)
 
-    query = select(LikeModel).where(LikeModel.author_id == user_id)
-    result = await session.execute(query)
-    for like in result.scalars().all():
-        await session.delete(like)
+@app.get('/admin/cache_stats', tags=['Админ ✨'])
+@limiter.limit("5/15 seconds")
+async def admin_cache_stats(
+        session: SessionDep,
+        request: Request,  # noqa
+        admin: AdminDep) -> dict:
+    return {
+        'responses': response_cache.stats(), 'tokens': token_cache.stats(), 'invalidation': invalidation_bus.stats(),
+        'like_buffer': like_buffer.stats(),
+    }
 
-    query = select(CommentModel).where(CommentModel.author_id == user_id)
-    result = await session.execute(query)
-    for comment in result.scalars().all():
-        await session.delete(comment)
 
-    await session.commit()
-    return {'ok': True}
+@app.delete('/admin/delete_user', status_code=202, tags=['Админ ✨'])
+@limiter.limit("5/30 seconds")
+async def delete_user(
+        user_id: int,
+        session: SessionDep,
+        request: Request,  # noqa
+        admin: AdminDep) -> dict:
+    job_id = await delete_account(session, user_id, owner_id=admin.user_id)
+    return {'ok': True, 'job_id': job_id}
+
+
+@app.get('/jobs/{job_id}', tags=['Админ ✨'])
+@limiter.limit("5/15 seconds")
+async def get_job(
+        job_id: int,
+        session: PrimarySessionDep,
+        request: Request,
+        job_token: Optional[str] = Header(default=None)) -> JobResponseSchema:
+    if job_token is not None:
+        verify_job_token(job_token, job_id)
+    else:
+        principal = await get_principal(request, session)
+    job = await session.get(JobModel, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail='Job not found')
+
+    if job_token is None and job.owner_id != principal.user_id and not principal.is_admin:
+        raise HTTPException(status_code=403, detail='This job is not yours')
+
+    return JobResponseSchema(
+        job_id=job.id, kind=job.kind, status=job.status, progress=job.progress, error=job.error,
+        created_at=job.created_at, finished_at=job.finished_at
+    )
+
 
+@app.get('/metrics', include_in_schema=False)
+async def metrics() -> PlainTextResponse:
+    return PlainTextResponse(render_metrics(), media_type=METRICS_CONTENT_TYPE)
 
 
 if __name__ == '__main__':
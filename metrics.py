@@ -0,0 +1,146 @@
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from starlette.datastructures import MutableHeaders
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') == '1'
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+
+class RequestTimings:
+    __slots__ = ('started', 'statements', 'spans')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.spans = {'db': 0.0, 'auth': 0.0, 'limit': 0.0}
+
+    def server_timing(self, total: float) -> str:
+        parts = [f'{name};dur={seconds * 1000:.2f}' for name, seconds in self.spans.items()]
+        parts[0] += f';desc="statements: {self.statements}"'
+        parts.append(f'total;dur={total * 1000:.2f}')
+        return ', '.join(parts)
+
+
+# None outside of a request, so the hooks below cost a single context variable lookup when idle
+current_timings = ContextVar('current_timings', default=None)
+
+
+@contextmanager
+def span(name: str):
+    timings = current_timings.get()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.spans[name] += time.perf_counter() - started
+
+
+# the start time lives on the statement's execution context, so a statement that fails never leaves it behind
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):  # noqa
+    if current_timings.get() is not None and context is not None:
+        context.query_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):  # noqa
+    timings = current_timings.get()
+    started = getattr(context, 'query_started', None)
+    if timings is not None and started is not None:
+        timings.statements += 1
+        timings.spans['db'] += time.perf_counter() - started
+
+
+def instrument_engine(engine):
+    event.listen(engine.sync_engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine.sync_engine, 'after_cursor_execute', after_cursor_execute)
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets: tuple):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self._series = {}
+
+    def observe(self, labels: tuple, value: float):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for (method, route), (counts, total) in sorted(self._series.items()):
+            labels = f'method="{method}",route="{route}"'
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total}')
+            lines.append(f'{self.name}_count{{{labels}}} {cumulative}')
+        return lines
+
+
+HISTOGRAMS = {
+    'total': Histogram('http_request_duration_seconds', 'Time spent handling the request.', SECONDS_BUCKETS),
+    'db': Histogram('http_request_db_seconds', 'Time spent executing SQL statements.', SECONDS_BUCKETS),
+    'auth': Histogram('http_request_auth_seconds', 'Time spent verifying the access token.', SECONDS_BUCKETS),
+    'limit': Histogram('http_request_rate_limit_seconds', 'Time spent in rate limit storage.', SECONDS_BUCKETS),
+    'statements': Histogram('http_request_db_statements', 'SQL statements executed per request.', STATEMENT_BUCKETS),
+}
+
+# process level values that are set once, like the startup time
+GAUGES = {}
+
+
+def set_gauge(name: str, documentation: str, value: float):
+    GAUGES[name] = (documentation, value)
+
+
+def render_metrics() -> str:
+    lines = []
+    for histogram in HISTOGRAMS.values():
+        lines.extend(histogram.render())
+    for name, (documentation, value) in sorted(GAUGES.items()):
+        lines.extend((f'# HELP {name} {documentation}', f'# TYPE {name} gauge', f'{name} {value}'))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        timings = RequestTimings()
+        reset_token = current_timings.set(timings)
+
+        async def send_with_timing(message):
+            if message['type'] == 'http.response.start':
+                headers = MutableHeaders(scope=message)
+                headers.append('Server-Timing', timings.server_timing(time.perf_counter() - timings.started))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_timings.reset(reset_token)
+            route = scope.get('route')
+            labels = (scope['method'], route.path if route is not None else 'unmatched')
+            HISTOGRAMS['total'].observe(labels, time.perf_counter() - timings.started)
+            HISTOGRAMS['statements'].observe(labels, timings.statements)
+            for name, seconds in timings.spans.items():
+                HISTOGRAMS[name].observe(labels, seconds)
@@ -0,0 +1,260 @@
+import asyncio
+import fcntl
+import logging
+import os
+import tempfile
+import time
+from contextlib import asynccontextmanager
+
+from sqlalchemy import Table, MetaData, Column, Integer, String, Float, select, insert, inspect, text
+
+from database import engine
+
+logger = logging.getLogger('uvicorn.error')
+
+MIGRATION_LOCK_PATH = os.getenv('MIGRATION_LOCK_PATH', f'{tempfile.gettempdir()}/fastapi-second-steps-migrations.lock')
+MIGRATION_LOCK_KEY = 20240601
+
+# Kept outside Base.metadata, so resetting the data through drop_all doesn't forget the schema version
+schema_migrations = Table(
+    'schema_migrations', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('name', String),
+    Column('applied_at', Float),
+)
+
+MIGRATIONS = []
+
+
+def migration(version: int, name: str):
+    def register(func):
+        MIGRATIONS.append((version, name, func))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return func
+    return register
+
+
+@asynccontextmanager
+async def migration_lock():
+    # workers start at the same time, only one of them migrates and the others find nothing left to do
+    if engine.dialect.name == 'postgresql':
+        async with engine.connect() as conn:
+            await conn.execute(text('SELECT pg_advisory_lock(:key)'), {'key': MIGRATION_LOCK_KEY})
+            try:
+                yield
+            finally:
+                await conn.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': MIGRATION_LOCK_KEY})
+        return
+    fd = os.open(MIGRATION_LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        await asyncio.to_thread(fcntl.flock, fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+async def migrate() -> list:
+    async with migration_lock():
+        async with engine.begin() as conn:
+            await conn.run_sync(schema_migrations.create, checkfirst=True)
+            result = await conn.execute(select(schema_migrations.c.version))
+            applied = set(result.scalars().all())
+
+        pending = [(version, name, func) for version, name, func in MIGRATIONS if version not in applied]
+        for version, name, func in pending:
+            started = time.perf_counter()
+            await func()
+            async with engine.begin() as conn:
+                await conn.execute(insert(schema_migrations).values(version=version, name=name, applied_at=time.time()))
+            logger.info('Applied migration %s (%s) in %.0f ms', version, name, (time.perf_counter() - started) * 1000)
+        return [version for version, _, _ in pending]
+
+
+async def autocommit_connection():
+    # CREATE INDEX CONCURRENTLY refuses to run inside a transaction
+    conn = await engine.connect()
+    return await conn.execution_options(isolation_level='AUTOCOMMIT')
+
+
+def index_ddl(name: str, table: str = None, columns: tuple = (), unique: bool = False, drop: bool = False) -> str:
+    concurrently = ' CONCURRENTLY' if engine.dialect.name == 'postgresql' else ''
+    if drop:
+        return f'DROP INDEX{concurrently} IF EXISTS {name}'
+    unique = 'UNIQUE ' if unique else ''
+    return f'CREATE {unique}INDEX{concurrently} IF NOT EXISTS {name} ON {table} ({", ".join(columns)})'
+
+
+# Migrations are snapshots: they use table and column names instead of the models and the app's helpers,
+# so later changes to the code can't change what an old migration does.
+
+# the tables as they were when migrations were introduced, their indexes are built by migration 4
+schema_v1 = MetaData()
+for name, *columns in (
+    ('users', Column('username', String), Column('password', String), Column('bio', String),
+     Column('age', Integer), Column('role', String)),
+    ('posts', Column('author_id', Integer), Column('title', String), Column('body', String),
+     Column('like_count', Integer), Column('comment_count', Integer), Column('version', Integer)),
+    ('likes', Column('post_id', Integer), Column('author_id', Integer)),
+    ('comments', Column('post_id', Integer), Column('author_id', Integer), Column('title', String)),
+    ('feed_entries', Column('user_id', Integer), Column('post_id', Integer)),
+    ('jobs', Column('kind', String), Column('params', String), Column('owner_id', Integer),
+     Column('status', String), Column('progress', Integer), Column('error', String),
+     Column('created_at', Float), Column('finished_at', Float)),
+):
+    Table(name, schema_v1, Column('id', Integer, primary_key=True), *columns)
+
+
+@migration(1, 'create tables')
+async def create_tables():
+    # tables that already exist are left alone, migration 3 brings old posts tables up to date
+    async with engine.begin() as conn:
+        await conn.run_sync(schema_v1.create_all)
+
+
+@migration(2, 'deduplicate likes')
+async def deduplicate_likes():
+    async with engine.begin() as conn:
+        await conn.execute(text(
+            'DELETE FROM likes WHERE id NOT IN (SELECT min(id) FROM likes GROUP BY post_id, author_id)'
+        ))
+
+
+@migration(3, 'post counters')
+async def add_post_counters():
+    async with engine.begin() as conn:
+        columns = await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_columns('posts'))
+        existing = {column['name'] for column in columns}
+        missing = [name for name in ('like_count', 'comment_count', 'version') if name not in existing]
+        for name in missing:
+            await conn.execute(text(f'ALTER TABLE posts ADD COLUMN {name} INTEGER DEFAULT 0'))
+        if missing:
+            await conn.execute(text(
+                'UPDATE posts SET '
+                'like_count = (SELECT count(*) FROM likes WHERE likes.post_id = posts.id), '
+                'comment_count = (SELECT count(*) FROM comments WHERE comments.post_id = posts.id)'
+            ))
+
+
+INDEXES_V4 = (
+    ('ix_users_username', 'users', ('username',), True),
+    ('ix_posts_author_id', 'posts', ('author_id',), False),
+    ('ix_likes_post_id_author_id', 'likes', ('post_id', 'author_id'), True),
+    ('ix_likes_author_id', 'likes', ('author_id',), False),
+    ('ix_comments_post_id', 'comments', ('post_id',), False),
+    ('ix_comments_author_id', 'comments', ('author_id',), False),
+    ('ix_feed_entries_user_id_post_id', 'feed_entries', ('user_id', 'post_id'), True),
+    ('ix_feed_entries_post_id', 'feed_entries', ('post_id',), False),
+    ('ix_jobs_status', 'jobs', ('status',), False),
+)
+
+
+async def deduplicate_usernames(conn):
+    # older versions didn't enforce unique usernames; the oldest account keeps the name, the later ones get
+    # their id appended, plus a counter if even that name is taken. Accounts without a duplicate keep theirs.
+    result = await conn.execute(text(
+        'SELECT id, username FROM users WHERE username IS NOT NULL AND id NOT IN '
+        '(SELECT min(id) FROM users WHERE username IS NOT NULL GROUP BY username) ORDER BY id'
+    ))
+    duplicates = result.all()
+    if not duplicates:
+        return
+    result = await conn.execute(text('SELECT username FROM users WHERE username IS NOT NULL'))
+    taken = set(result.scalars().all())
+    for user_id, username in duplicates:
+        renamed, attempt = f'{username}-{user_id}', 1
+        while renamed in taken:
+            attempt += 1
+            renamed = f'{username}-{user_id}-{attempt}'
+        taken.add(renamed)
+        await conn.execute(text('UPDATE users SET username = :username WHERE id = :id'),
+                           {'username': renamed, 'id': user_id})
+    logger.warning('Renamed %s users with a duplicate username', len(duplicates))
+
+
+@migration(4, 'sync indexes')
+async def sync_indexes():
+    # drops the indexes older versions created and this list doesn't declare anymore, builds the missing ones.
+    # Usernames are deduplicated here rather than in a migration of their own, because a database that has
+    # them never got past this migration and any later version number would run after it.
+    async with engine.begin() as conn:
+        await deduplicate_usernames(conn)
+    conn = await autocommit_connection()
+    try:
+        for table in dict.fromkeys(table for _, table, _, _ in INDEXES_V4):
+            existing = await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_indexes(table))
+            existing = {index['name']: index for index in existing}
+            declared = {name: (columns, unique) for name, index_table, columns, unique in INDEXES_V4
+                        if index_table == table}
+            for name, index in existing.items():
+                wanted = declared.get(name)
+                if wanted is None or bool(index['unique']) != wanted[1] or tuple(index['column_names']) != wanted[0]:
+                    await conn.execute(text(index_ddl(name, drop=True)))
+                    existing[name] = None
+            for name, (columns, unique) in declared.items():
+                if existing.get(name) is None:
+                    await conn.execute(text(index_ddl(name, table, columns, unique)))
+    finally:
+        await conn.close()
+
+
+@migration(5, 'search index')
+async def build_search_index():
+    # FTS5 is sqlite only; databases created before search existed get the index built from their rows,
+    # a post under rowid 2 * id and a comment under 2 * id + 1
+    if engine.dialect.name != 'sqlite':
+        return
+    async with engine.begin() as conn:
+        await conn.execute(text(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(title, body, kind UNINDEXED, '
+            "post_id UNINDEXED, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        ))
+        if (await conn.execute(text('SELECT rowid FROM search_index LIMIT 1'))).first() is not None:
+            return
+        await conn.execute(text(
+            'INSERT INTO search_index (rowid, title, body, kind, post_id) '
+            "SELECT id * 2, title, body, 'post', id FROM posts"
+        ))
+        await conn.execute(text(
+            'INSERT INTO search_index (rowid, title, body, kind, post_id) '
+            "SELECT id * 2 + 1, title, NULL, 'comment', post_id FROM comments"
+        ))
+
+
+@migration(6, 'posts autoincrement')
+async def posts_autoincrement():
+    # sqlite reuses the rowid of the newest post after it is deleted unless the table is AUTOINCREMENT,
+    # which only CREATE TABLE can set, so the table is rebuilt; other databases never reuse serial ids
+    if engine.dialect.name != 'sqlite':
+        return
+    async with engine.begin() as conn:
+        result = await conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'posts'"))
+        if 'AUTOINCREMENT' in result.scalar().upper():
+            return
+        columns = 'id, author_id, title, body, like_count, comment_count, version'
+        await conn.execute(text(
+            'CREATE TABLE posts_autoincrement (id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, author_id INTEGER, '
+            'title VARCHAR, body VARCHAR, like_count INTEGER DEFAULT 0, comment_count INTEGER DEFAULT 0, '
+            'version INTEGER DEFAULT 0)'
+        ))
+        await conn.execute(text(f'INSERT INTO posts_autoincrement ({columns}) SELECT {columns} FROM posts'))
+        await conn.execute(text('DROP TABLE posts'))
+        await conn.execute(text('ALTER TABLE posts_autoincrement RENAME TO posts'))
+        await conn.execute(text('CREATE INDEX IF NOT EXISTS ix_posts_author_id ON posts (author_id)'))
+
+
+@migration(7, 'job claims')
+async def add_job_claims():
+    async with engine.begin() as conn:
+        columns = await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_columns('jobs'))
+        if 'claimed_at' not in {column['name'] for column in columns}:
+            await conn.execute(text('ALTER TABLE jobs ADD COLUMN claimed_at FLOAT'))
+
+
+@migration(8, 'likes post index')
+async def add_likes_post_index():
+    conn = await autocommit_connection()
+    try:
+        await conn.execute(text(index_ddl('ix_likes_post_id', 'likes', ('post_id',))))
+    finally:
+        await conn.close()
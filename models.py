@@ -1,12 +1,12 @@
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, Integer, String, Float, Index
 from database import Base
 
 
 class UserModel(Base):
     __tablename__ = 'users'
 
-    id = Column(Integer, primary_key=True, index=True)
-    username = Column(String, index=True)
+    id = Column(Integer, primary_key=True)
+    username = Column(String, unique=True, index=True)
     password = Column(String)
     bio = Column(String)
     age = Column(Integer)
@@ -15,25 +15,61 @@ class UserModel(Base):
 
 class PostModel(Base):
     __tablename__ = 'posts'
+    # ETags are built from the post id, so an id must never be handed out twice
+    __table_args__ = {'sqlite_autoincrement': True}
 
-    id = Column(Integer, primary_key=True, index=True)
-    author_id = Column(Integer)
-    title = Column(String, index=True)
+    id = Column(Integer, primary_key=True)
+    author_id = Column(Integer, index=True)
+    title = Column(String)
     body = Column(String)
+    like_count = Column(Integer, default=0)
+    comment_count = Column(Integer, default=0)
+    version = Column(Integer, default=0)
 
 
 class LikeModel(Base):
     __tablename__ = 'likes'
+    __table_args__ = (
+        Index('ix_likes_post_id_author_id', 'post_id', 'author_id', unique=True),
+    )
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
+    # keeps a post's likes in id order for the keyset pages, the unique index doesn't
     post_id = Column(Integer, index=True)
-    author_id = Column(Integer)
+    author_id = Column(Integer, index=True)
 
 
 class CommentModel(Base):
     __tablename__ = 'comments'
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     post_id = Column(Integer, index=True)
-    author_id = Column(Integer)
+    author_id = Column(Integer, index=True)
     title = Column(String)
+
+
+class FeedEntryModel(Base):
+    __tablename__ = 'feed_entries'
+    __table_args__ = (
+        Index('ix_feed_entries_user_id_post_id', 'user_id', 'post_id', unique=True),
+    )
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer)
+    post_id = Column(Integer, index=True)
+
+
+class JobModel(Base):
+    __tablename__ = 'jobs'
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String)
+    params = Column(String)
+    owner_id = Column(Integer)
+    status = Column(String, index=True)
+    progress = Column(Integer, default=0)
+    error = Column(String)
+    created_at = Column(Float)
+    finished_at = Column(Float)
+    # set when a worker claims the job and on every chunk it finishes
+    claimed_at = Column(Float)
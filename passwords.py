@@ -0,0 +1,50 @@
+import asyncio
+import hashlib
+import hmac
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+SCRYPT_N = int(os.getenv('SCRYPT_N', 2 ** 14))
+SCRYPT_R = int(os.getenv('SCRYPT_R', 8))
+SCRYPT_P = int(os.getenv('SCRYPT_P', 1))
+SALT_SIZE = 16
+HASH_WORKERS = int(os.getenv('HASH_WORKERS', 4))
+
+executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='password-hash')
+offload = True
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r * p)
+
+
+def _hash(password: str) -> str:
+    salt = os.urandom(SALT_SIZE)
+    digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f'scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}'
+
+
+def _verify(password: str, password_hash: str) -> tuple:
+    if '$' not in password_hash:
+        legacy_hash = hashlib.md5(password.encode()).hexdigest()
+        return hmac.compare_digest(legacy_hash, password_hash), True
+
+    _, n, r, p, salt, digest = password_hash.split('$')
+    n, r, p = int(n), int(r), int(p)
+    ok = hmac.compare_digest(_scrypt(password, bytes.fromhex(salt), n, r, p).hex(), digest)
+    return ok, (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+
+async def _run(func, *args):
+    if not offload:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+async def hash_password(password: str) -> str:
+    return await _run(_hash, password)
+
+
+# returns (matches, needs_rehash): legacy md5 hashes and outdated scrypt costs need a rehash
+async def verify_password(password: str, password_hash: str) -> tuple:
+    return await _run(_verify, password, password_hash)
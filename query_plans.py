@@ -0,0 +1,154 @@
+import asyncio
+import os
+import re
+import sys
+import tempfile
+
+# run against a throwaway sqlite file, EXPLAIN QUERY PLAN is sqlite specific
+os.environ['DATABASE_URL'] = f'sqlite+aiosqlite:///{tempfile.mkdtemp()}/query_plans.db'
+
+import httpx  # noqa: E402
+from sqlalchemy import event, insert  # noqa: E402
+
+from models import Base, UserModel, PostModel, LikeModel, CommentModel  # noqa: E402
+from database import engine, session_local  # noqa: E402
+from jwt_authx import auth  # noqa: E402
+from main import app, limiter  # noqa: E402
+from jobs import job_queue  # noqa: E402
+
+USERS = 20
+POSTS = 200
+
+ROUTES = [
+    ('GET', '/users', {}),
+    ('GET', '/users', {'after': 5, 'limit': 5}),
+    ('GET', '/users/2', {}),
+    ('GET', '/posts', {'after': 10, 'limit': 10}),
+    ('GET', '/posts/3', {}),
+    ('POST', '/posts', {}, {'title': 'title', 'body': 'body'}),
+    ('GET', '/feed', {}),
+    ('GET', '/feed', {'before': POSTS, 'limit': 10}),
+    ('GET', '/search', {'q': 'post 1'}),
+    ('POST', '/comments', {}, {'post_id': 3, 'title': 'comment'}),
+    ('GET', '/likes', {'post_id': 3, 'after': 1}),
+    ('GET', '/comments', {'post_id': 3, 'after': 1}),
+    ('POST', '/likes', {'post_id': 7}),
+    ('POST', '/likes', {'post_id': 7}),
+    ('POST', '/likes', {'post_id': POSTS + 1}),
+    ('DELETE', '/likes', {'like_id': 1}),
+    ('DELETE', '/comments', {'comment_id': 1}),
+    ('DELETE', '/admin/delete_like', {'like_id': 2}),
+    ('DELETE', '/admin/delete_comment', {'comment_id': 2}),
+    ('DELETE', '/posts', {'post_id': 1}),
+    ('DELETE', '/admin/delete_user', {'user_id': 3}),
+    ('DELETE', '/users', {}),
+]
+
+
+async def seed():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with session_local() as session:
+        await session.execute(insert(UserModel), [
+            {'username': f'user{i}', 'password': '', 'bio': '', 'age': 0, 'role': 'admin' if i == 1 else 'user'}
+            for i in range(1, USERS + 1)
+        ])
+        await session.execute(insert(PostModel), [
+            {'author_id': i % USERS + 1, 'title': f'post {i}', 'body': 'body', 'like_count': USERS,
+             'comment_count': USERS}
+            for i in range(POSTS)
+        ])
+        await session.execute(insert(LikeModel), [
+            {'post_id': post_id, 'author_id': author_id}
+            for post_id in range(1, POSTS + 1) for author_id in range(1, USERS + 1)
+        ])
+        await session.execute(insert(CommentModel), [
+            {'post_id': post_id, 'author_id': author_id, 'title': 'comment'}
+            for post_id in range(1, POSTS + 1) for author_id in range(1, USERS + 1)
+        ])
+        await session.commit()
+
+
+async def collect_statements() -> list:
+    statements = []
+    route = None
+
+    def record(conn, cursor, statement, parameters, context, executemany):  # noqa
+        if statement.lstrip().split(None, 1)[0].upper() in ('SELECT', 'UPDATE', 'DELETE', 'INSERT'):
+            statements.append((route, statement, parameters))
+
+    token = auth.create_access_token(uid='1', data={'role': 'admin'})
+    transport = httpx.ASGITransport(app=app)
+    headers = {'Authorization': f'Bearer {token}'}
+    event.listen(engine.sync_engine, 'before_cursor_execute', record)
+    async with httpx.AsyncClient(transport=transport, base_url='http://plans', headers=headers) as client:
+        for method, url, params, *body in ROUTES:
+            route = f'{method} {url}'
+            await client.request(method, url, params=params, json=body[0] if body else None)
+            await job_queue.join()
+    event.remove(engine.sync_engine, 'before_cursor_execute', record)
+    return statements
+
+
+def full_scans(statement: str, plan: list) -> list:
+    # scans of materialized subqueries are bounded by the indexed lookups that fill them
+    statement = ' '.join(statement.split())
+    scans = []
+    for *_, detail in plan:
+        words = detail.split()
+        if len(words) < 2 or words[1] not in Base.metadata.tables:
+            continue
+        if words[0] == 'SCAN' and not primary_key_page(statement, plan):
+            scans.append(detail)
+        elif words[0] == 'SEARCH' and re.search(r'INTEGER PRIMARY KEY \(rowid[<>]', detail):
+            # a rowid range only narrows the statement when nothing else of the table is filtered
+            if filtered_columns(statement, words[1]) - {'id'}:
+                scans.append(detail)
+    # a page that sorts in memory reads every matching row before LIMIT applies
+    if sorted_page(statement):
+        scans.extend(detail for *_, detail in plan if detail.startswith('USE TEMP B-TREE FOR ORDER BY'))
+    return scans
+
+
+def primary_key_page(statement: str, plan: list) -> bool:
+    # an unfiltered page walks the table in rowid order and stops at LIMIT
+    statement = statement.upper()
+    sorted_in_memory = any('TEMP B-TREE' in detail for *_, detail in plan)
+    return ' WHERE ' not in statement and not sorted_in_memory \
+        and re.search(r' ORDER BY \w+\.ID( ASC| DESC)? LIMIT ', statement) is not None
+
+
+def sorted_page(statement: str) -> bool:
+    # ordered by a table column, relevance ordered search results have to be sorted anyway
+    match = re.search(r' ORDER BY (\w+?)(_\d+)?\.\w+( ASC| DESC)?( LIMIT |, )', statement)
+    return match is not None and match.group(1) in Base.metadata.tables
+
+
+def filtered_columns(statement: str, table: str) -> set:
+    _, _, condition = statement.partition(' WHERE ')
+    return set(re.findall(rf'\b{table}\.(\w+)', condition.split(' ORDER BY ')[0]))
+
+
+async def check_plans() -> int:
+    await seed()
+    statements = await collect_statements()
+    failures = 0
+    async with engine.connect() as conn:
+        for route, statement, parameters in statements:
+            plan = (await conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters)).all()
+            scans = full_scans(statement, plan)
+            if scans:
+                failures += 1
+                print(f'FULL SCAN OR SORT in {route}: {", ".join(scans)}')
+                print(f'    {" ".join(statement.split())}')
+    print(f'{len(statements)} statements checked, {failures} full scans or in-memory sorts')
+    return failures
+
+
+def main():
+    limiter.enabled = False
+    sys.exit(1 if asyncio.run(check_plans()) else 0)
+
+
+if __name__ == '__main__':
+    main()
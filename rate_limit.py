@@ -0,0 +1,148 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse, parse_qs
+
+from limits.storage import Storage
+
+from metrics import span
+
+RATE_LIMIT_STORAGE_URI = os.getenv(
+    'RATE_LIMIT_STORAGE_URI', f'shm://{tempfile.gettempdir()}/fastapi-second-steps-rate-limits'
+)
+
+SLOT = struct.Struct('<Qdq')  # key hash, window expiry, hit count
+DEFAULT_SLOTS = 65536
+PROBE_LIMIT = 32
+MAX_EXHAUSTED = 100000
+
+
+def limit_from_key(key: str):
+    # limits builds keys as LIMITER/<identifiers>/<amount>/<multiples>/<granularity>
+    try:
+        return int(key.rsplit('/', 3)[-3])
+    except (IndexError, ValueError):
+        return None
+
+
+# Fixed-window counters in an mmap'ed file shared by every worker process on the host.
+# Every admitted hit is counted under the cross-process file lock, so no worker can hold on to hits
+# another one needs. A window's count never goes down, so once it is past the limit each process
+# remembers that and rejects the rest of the window's hits without taking the lock.
+# There is deliberately no local fast path for hits under the limit: handing a process a share of the
+# window ahead of time (a local token bucket or a lease) either lets the workers together exceed the limit
+# or strands the share in a worker that gets no more traffic, admitting fewer hits than the limit. An
+# admitted hit costs one flock round trip instead, about 7 us against 1.5 us for a rejected one.
+class SharedMemoryStorage(Storage):
+    STORAGE_SCHEME = ['shm']
+
+    def __init__(self, uri: str, wrap_exceptions: bool = False, **options):
+        parsed = urlparse(uri)
+        self.path = parsed.path
+        self.slots = int(parse_qs(parsed.query).get('slots', [DEFAULT_SLOTS])[0])
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = self.slots * SLOT.size
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._thread_lock = threading.Lock()
+        self._exhausted = {}
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+
+    @property
+    def base_exceptions(self):
+        return OSError
+
+    @contextmanager
+    def _locked(self):
+        with self._thread_lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+
+    def _find(self, key_hash: int, now: float, create: bool):
+        start = key_hash % self.slots
+        free, oldest, oldest_expiry = None, None, float('inf')
+        for probe in range(PROBE_LIMIT):
+            index = (start + probe) % self.slots
+            slot_hash, expires_at, count = SLOT.unpack_from(self._map, index * SLOT.size)
+            if slot_hash == key_hash:
+                if expires_at <= now:
+                    return index, 0, 0.0
+                return index, count, expires_at
+            if free is None and (slot_hash == 0 or expires_at <= now):
+                free = index
+            if expires_at < oldest_expiry:
+                oldest, oldest_expiry = index, expires_at
+        if not create:
+            return None, 0, 0.0
+        return (free if free is not None else oldest), 0, 0.0
+
+    def _reserve(self, key: str, expiry: float, amount: int):
+        now = time.time()
+        key_hash = self._hash(key)
+        with self._locked():
+            index, count, expires_at = self._find(key_hash, now, create=True)
+            if not expires_at:
+                expires_at = now + expiry
+            SLOT.pack_into(self._map, index * SLOT.size, key_hash, expires_at, count + amount)
+        return count + amount, expires_at
+
+    def _prune_exhausted(self, now: float):
+        for key in [key for key, (expires_at, _) in self._exhausted.items() if expires_at <= now]:
+            del self._exhausted[key]
+
+    def incr(self, key: str, expiry: float, amount: int = 1) -> int:
+        with span('limit'):
+            return self._incr(key, expiry, amount)
+
+    def _incr(self, key: str, expiry: float, amount: int) -> int:
+        now = time.time()
+        exhausted = self._exhausted.get(key)
+        if exhausted is not None and exhausted[0] > now:
+            return exhausted[1] + amount
+
+        count, expires_at = self._reserve(key, expiry, amount)
+        limit = limit_from_key(key)
+        if limit is not None and count > limit:
+            if len(self._exhausted) >= MAX_EXHAUSTED:
+                self._prune_exhausted(now)
+            self._exhausted[key] = (expires_at, count)
+        return count
+
+    def get(self, key: str) -> int:
+        with span('limit'), self._locked():
+            return self._find(self._hash(key), time.time(), create=False)[1]
+
+    def get_expiry(self, key: str) -> float:
+        with span('limit'), self._locked():
+            expires_at = self._find(self._hash(key), time.time(), create=False)[2]
+        return expires_at or time.time()
+
+    def check(self) -> bool:
+        return not self._map.closed
+
+    def reset(self):
+        with self._locked():
+            self._map[:] = bytes(len(self._map))
+        self._exhausted.clear()
+        return None
+
+    def clear(self, key: str) -> None:
+        self._exhausted.pop(key, None)
+        with self._locked():
+            index = self._find(self._hash(key), time.time(), create=False)[0]
+            if index is not None:
+                SLOT.pack_into(self._map, index * SLOT.size, 0, 0.0, 0)
@@ -1,4 +1,8 @@
-from pydantic import BaseModel
+from typing import List, Optional
+
+from pydantic import BaseModel, Field, TypeAdapter
+
+MAX_BATCH_SIZE = 500
 
 
 class UserSchema(BaseModel):
@@ -11,6 +15,11 @@ class UserResponseSchema(UserSchema):
     user_id: int
 
 
+class UserPageSchema(BaseModel):
+    items: List[UserResponseSchema]
+    next_cursor: Optional[int]
+
+
 class UserRegisterSchema(UserSchema):
     password: str
 
@@ -31,12 +40,26 @@ class PostResponseSchema(PostCreateSchema):
     likes: int
 
 
+class PostPageSchema(BaseModel):
+    items: List[PostResponseSchema]
+    next_cursor: Optional[int]
+
+
 class LikeResponseSchema(BaseModel):
     like_id: int
     post_id: int
     author_id: int
 
 
+class LikePageSchema(BaseModel):
+    items: List[LikeResponseSchema]
+    next_cursor: Optional[int]
+
+
+class LikeBatchSchema(BaseModel):
+    post_ids: List[int] = Field(min_length=1, max_length=MAX_BATCH_SIZE)
+
+
 class CommentSchema(BaseModel):
     post_id: int
     title: str
@@ -45,3 +68,49 @@ class CommentSchema(BaseModel):
 class CommentResponseSchema(CommentSchema):
     comment_id: int
     author_id: int
+
+
+class CommentPageSchema(BaseModel):
+    items: List[CommentResponseSchema]
+    next_cursor: Optional[int]
+
+
+class CommentBatchSchema(BaseModel):
+    comments: List[CommentSchema] = Field(min_length=1, max_length=MAX_BATCH_SIZE)
+
+
+class BatchItemResultSchema(BaseModel):
+    post_id: int
+    ok: bool
+    detail: Optional[str] = None
+
+
+class SearchResultSchema(BaseModel):
+    kind: str
+    post_id: int
+    comment_id: Optional[int]
+    title: str
+    snippet: str
+    score: float
+
+
+class SearchPageSchema(BaseModel):
+    items: List[SearchResultSchema]
+    next_cursor: Optional[int]
+
+
+class JobResponseSchema(BaseModel):
+    job_id: int
+    kind: str
+    status: str
+    progress: int
+    error: Optional[str]
+    created_at: float
+    finished_at: Optional[float]
+
+
+user_list_adapter = TypeAdapter(List[UserResponseSchema])
+post_list_adapter = TypeAdapter(List[PostResponseSchema])
+like_list_adapter = TypeAdapter(List[LikeResponseSchema])
+comment_list_adapter = TypeAdapter(List[CommentResponseSchema])
+search_list_adapter = TypeAdapter(List[SearchResultSchema])
@@ -0,0 +1,117 @@
+import re
+from typing import Optional
+
+from sqlalchemy import Table, MetaData, Column, Integer, String, DDL, event, select, delete, insert, func, \
+    literal, literal_column, case, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import Base, engine
+from models import PostModel, CommentModel
+
+# FTS5 is sqlite only, on other databases the index is not maintained and /search is unavailable
+SEARCH_ENABLED = engine.dialect.name == 'sqlite'
+SEARCH_TOKENIZER = 'unicode61 remove_diacritics 2'
+TITLE_WEIGHT = 10.0
+BODY_WEIGHT = 1.0
+SNIPPET_TOKENS = 12
+
+# Posts and comments share one index: a post is stored under rowid 2 * id, a comment under 2 * id + 1.
+# The table lives outside Base.metadata because create_all can't build virtual tables.
+search_index = Table(
+    'search_index', MetaData(),
+    Column('rowid', Integer, primary_key=True),
+    Column('title', String),
+    Column('body', String),
+    Column('kind', String),
+    Column('post_id', Integer),
+)
+search_match = literal_column('search_index')
+
+CREATE_SEARCH_INDEX = (
+    'CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5('
+    f"title, body, kind UNINDEXED, post_id UNINDEXED, tokenize='{SEARCH_TOKENIZER}', prefix='2 3')"
+)
+
+event.listen(Base.metadata, 'after_create', DDL(CREATE_SEARCH_INDEX).execute_if(dialect='sqlite'))
+event.listen(Base.metadata, 'before_drop', DDL('DROP TABLE IF EXISTS search_index').execute_if(dialect='sqlite'))
+
+
+def post_document(post_id):
+    return post_id * 2
+
+
+def comment_document(comment_id):
+    return comment_id * 2 + 1
+
+
+def match_expression(text: str) -> Optional[str]:
+    # every word must match, a trailing * turns a word into a prefix; everything else is dropped so
+    # user input can't use the FTS5 query syntax
+    words = re.findall(r'(\w+)(\*?)', text.lower())
+    if not words:
+        return None
+    return ' '.join(f'"{word}"{prefix}' for word, prefix in words)
+
+
+async def index_post(session: AsyncSession, post_id: int, title: str, body: str):
+    if not SEARCH_ENABLED:
+        return
+    query = insert(search_index).values(
+        rowid=post_document(post_id), title=title, body=body, kind='post', post_id=post_id
+    )
+    await session.execute(query)
+
+
+async def index_comments(session: AsyncSession, comments: list):
+    if not SEARCH_ENABLED or not comments:
+        return
+    await session.execute(insert(search_index), [
+        {'rowid': comment_document(comment_id), 'title': title, 'body': None, 'kind': 'comment', 'post_id': post_id}
+        for comment_id, post_id, title in comments
+    ])
+
+
+async def unindex_comments(session: AsyncSession, comment_ids: list):
+    if SEARCH_ENABLED and comment_ids:
+        documents = [comment_document(comment_id) for comment_id in comment_ids]
+        await session.execute(delete(search_index).where(search_index.c.rowid.in_(documents)))
+
+
+async def unindex_posts(session: AsyncSession, post_ids: list):
+    # has to run before the posts' comments are deleted
+    if not SEARCH_ENABLED or not post_ids:
+        return
+    comments = select(comment_document(CommentModel.id)).where(CommentModel.post_id.in_(post_ids))
+    query = delete(search_index).where(or_(
+        search_index.c.rowid.in_([post_document(post_id) for post_id in post_ids]), search_index.c.rowid.in_(comments)
+    ))
+    await session.execute(query)
+
+
+async def rebuild_search_index(session: AsyncSession):
+    if not SEARCH_ENABLED:
+        return
+    posts = select(post_document(PostModel.id), PostModel.title, PostModel.body, literal('post'), PostModel.id)
+    comments = select(comment_document(CommentModel.id), CommentModel.title, literal(None), literal('comment'),
+                      CommentModel.post_id)
+    columns = ['rowid', 'title', 'body', 'kind', 'post_id']
+    for query in (
+        delete(search_index),
+        insert(search_index).from_select(columns, posts),
+        insert(search_index).from_select(columns, comments),
+    ):
+        await session.execute(query)
+
+
+def search_query(match: str, limit: int, offset: int):
+    rank = func.bm25(search_match, TITLE_WEIGHT, BODY_WEIGHT)
+    snippet = func.snippet(search_match, -1, '[', ']', '…', SNIPPET_TOKENS)
+    comment_id = case((search_index.c.kind == 'comment', search_index.c.rowid // 2), else_=None)
+    return select(
+        search_index.c.kind,
+        search_index.c.post_id,
+        comment_id.label('comment_id'),
+        search_index.c.title,
+        snippet.label('snippet'),
+        (-rank).label('score'),
+    ).where(search_match.op('MATCH')(match)).order_by(rank, search_index.c.rowid).offset(offset).limit(limit + 1)